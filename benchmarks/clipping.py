@@ -0,0 +1,121 @@
+''' Check that the geometry pipeline of build_query() is equivalent to the
+one it replaced, by running both in shapely on random shapes.
+
+    PYTHONPATH=src:test python benchmarks/clipping.py [--count N]
+
+Previous pipeline, for tolerance > 0:
+
+    ST_Intersection(ST_MakeValid(ST_SimplifyPreserveTopology(
+        ST_Intersection(g, <bounds padded by 10%>), t)), <bounds>)
+
+Current pipeline, see provider.st_geometry():
+
+    ST_MakeValid(ST_ClipByBox2D(ST_SimplifyPreserveTopology(
+        ST_ClipByBox2D(g, <bounds padded by buffer + t>), t), <bounds padded by buffer>))
+
+Rectangle clipping is stood in for by clip.intersection(), which like
+ST_ClipByBox2D takes invalid input, and ST_MakeValid by buffer(0) for
+polygons. For every shape and tolerance:
+
+- the current output is valid and lies within the buffered tile
+- polygons differ from the previous output inside the tile by less than
+  the tolerance times their perimeter, in area
+- lines stay within the tolerance of the original inside the tile, and
+  the original, away from the tile edges, within the tolerance of them.
+  Near the edges, either pipeline may keep or drop a short simplified
+  piece grazing the tile, so lines aren't compared with each other there
+
+The exit status is 1 when any shape fails.
+'''
+
+import sys
+import random
+import argparse
+from math import pi, cos, sin
+from shapely.geometry import box, Polygon, LineString
+import tile_gen.vectiles.provider as provider
+from tile_gen.vectiles.clip import intersection
+
+extent = 4096.
+
+def random_polygon(r):
+    x, y = r.uniform(-extent / 4, extent * 1.25), r.uniform(-extent / 4, extent * 1.25)
+    size = r.uniform(50, extent / 2)
+    vertices = r.randint(8, 200)
+    angles = sorted(r.uniform(0, 2 * pi) for n in range(vertices))
+    return Polygon([(x + size * r.uniform(0.3, 1) * cos(a), y + size * r.uniform(0.3, 1) * sin(a))
+                    for a in angles]).buffer(0)
+
+def random_line(r):
+    x, y = r.uniform(-extent / 4, extent * 1.25), r.uniform(-extent / 4, extent * 1.25)
+    coords = [(x, y)]
+    for n in range(r.randint(2, 200)):
+        x, y = x + r.uniform(-60, 60), y + r.uniform(-60, 60)
+        coords.append((x, y))
+    return LineString(coords)
+
+def make_valid(shape):
+    return shape.buffer(0) if shape.geom_type in ('Polygon', 'MultiPolygon') else shape
+
+def previous(shape, bounds, tolerance):
+    padded = box(*provider.pad(bounds, (bounds[3] - bounds[1]) * 0.1))
+    shape = shape.intersection(padded).simplify(tolerance, preserve_topology=True)
+    return make_valid(shape).intersection(box(*bounds))
+
+def current(shape, bounds, tolerance, buffer):
+    shape = intersection(shape, box(*provider.pad(bounds, buffer + tolerance)))
+    shape = shape.simplify(tolerance, preserve_topology=True)
+    return make_valid(intersection(shape, box(*provider.pad(bounds, buffer))))
+
+def check(shape, tolerance, buffer):
+    ''' Return a list of failures for one shape.
+    '''
+    bounds = (0, 0, extent, extent)
+    tile = box(*bounds)
+    before = previous(shape, bounds, tolerance)
+    after = current(shape, bounds, tolerance, buffer)
+    failures = []
+
+    if not after.is_valid:
+        failures.append('invalid')
+
+    if not after.is_empty and not after.within(box(*provider.pad(bounds, buffer + 1e-6))):
+        failures.append('outside the buffered tile')
+
+    inside = after.intersection(tile)
+    if shape.geom_type in ('Polygon', 'MultiPolygon'):
+        difference = inside.symmetric_difference(before).area
+        if difference > tolerance * max(before.length, inside.length, 1):
+            failures.append('area differs by %.1f' % difference)
+    else:
+        slack = tolerance * 1.001
+        interior = shape.intersection(box(*provider.pad(bounds, -tolerance)))
+
+        if not inside.is_empty and not inside.within(shape.buffer(slack)):
+            failures.append('line moved by more than the tolerance')
+        if not interior.is_empty and not interior.within(after.buffer(slack)):
+            failures.append('line lost inside the tile')
+
+    return failures
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=200, help='shapes per kind and tolerance')
+    parser.add_argument('--buffer', type=float, default=0, help='buffer in tile units')
+    args = parser.parse_args()
+
+    r = random.Random(0)
+    failed = 0
+
+    for tolerance in (1, 4, 16):
+        for kind, generate in (('polygons', random_polygon), ('lines', random_line)):
+            shapes = [generate(r) for n in range(args.count)]
+            failures = [(n, f) for (n, shape) in enumerate(shapes)
+                        for f in check(shape, tolerance, args.buffer)]
+
+            print '%-10s tolerance %-4d %d shapes, %d failures' % (kind, tolerance, len(shapes), len(failures))
+            for n, failure in failures[:5]:
+                print '  shape %d: %s' % (n, failure)
+            failed += len(failures)
+
+    sys.exit(1 if failed else 0)
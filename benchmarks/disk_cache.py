@@ -0,0 +1,73 @@
+''' Micro-benchmark for the Disk cache: file system calls and time per
+save, read and lock of a tile, for each directory layout.
+
+    PYTHONPATH=src python benchmarks/disk_cache.py [count]
+
+File system calls are counted by wrapping the os functions the cache and
+its helpers go through, which is close to, but not exactly, the number of
+system calls: writes and closes made through Python file objects aren't seen.
+'''
+
+import os
+import sys
+import time
+import shutil
+import __builtin__
+from tempfile import mkdtemp
+from collections import Counter
+from ModestMaps.Core import Coordinate
+import tile_gen.caches as caches
+
+counted = ['stat', 'lstat', 'fstat', 'mkdir', 'open', 'close', 'rename',
+           'chmod', 'fchmod', 'unlink', 'remove', 'umask', 'write']
+
+calls = Counter()
+
+def counting(name, fn):
+    def wrapper(*args, **kwargs):
+        calls[name] += 1
+        return fn(*args, **kwargs)
+    return wrapper
+
+def instrument():
+    for name in counted:
+        setattr(os, name, counting(name, getattr(os, name)))
+    __builtin__.open = counting('open', __builtin__.open)
+
+def measure(name, fn, coords):
+    calls.clear()
+    start = time.time()
+
+    for coord in coords:
+        fn(coord)
+
+    elapsed = time.time() - start
+    count = float(len(coords))
+    per_call = sorted((k, v / count) for (k, v) in calls.items())
+
+    print '%-8s %7.1f us/tile  %4.1f calls/tile  %s' % (
+        name, 1e6 * elapsed / count, sum(calls.values()) / count,
+        ', '.join('%s=%.1f' % kv for kv in per_call))
+
+def run(dirs, count):
+    path = mkdtemp()
+    cache = caches.Disk(path, dirs=dirs, gzip=[])
+    body = 'x' * 20000
+    coords = [Coordinate(1000 + n % 16, 2000 + n // 16, 14) for n in range(count)]
+
+    print '%s:' % dirs
+    measure('path', lambda c: cache._fullpath('roads', c, 'MVT'), coords)
+    measure('save', lambda c: cache.save(body, 'roads', c, 'MVT'), coords)
+    measure('resave', lambda c: cache.save(body, 'roads', c, 'MVT'), coords)
+    measure('read', lambda c: cache.read('roads', c, 'MVT'), coords)
+    measure('miss', lambda c: cache.read('roads', Coordinate(c.row, c.column, 15), 'MVT'), coords)
+    measure('lock', lambda c: (cache.lock('roads', c, 'MVT'), cache.unlock('roads', c, 'MVT')), coords)
+
+    shutil.rmtree(path)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    instrument()
+
+    for dirs in ('safe', 'portable', 'quadtile'):
+        run(dirs, count)
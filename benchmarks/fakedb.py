@@ -0,0 +1,160 @@
+''' A stand-in for PostGIS that replays recorded or synthetic rows, so the
+render pipeline can be measured without a database.
+
+Rows look like what RealDictCursor returns for a query built by
+build_query(): a dict with a "__geometry__" WKB buffer already scaled to
+tile space, an "__id__" and any number of properties, None included.
+
+Recorded rows are read from a JSON file mapping layer names to lists of
+rows, with "__geometry__" given as hex-encoded WKB, ex:
+
+    {"roads": [{"__geometry__": "0102...", "__id__": 1, "highway": "primary"}]}
+'''
+
+import json
+import random
+from math import cos, sin, pi
+from binascii import unhexlify
+from shapely.geometry import Point, LineString, Polygon
+import tile_gen.vectiles.provider as provider
+
+extent = 4096
+
+highways = ['motorway', 'trunk', 'primary', 'secondary', 'tertiary',
+            'primary_link', 'residential', 'residential', 'residential',
+            'service', 'service', 'footway', 'path', 'track', 'unclassified']
+names = ['Main Street', 'North Avenue', 'Elm Street', 'Broadway', None, None]
+buildings = ['yes', 'yes', 'yes', 'house', 'residential', 'commercial', 'school']
+landuses = ['park', 'forest', 'residential', 'grass', 'farmland', 'cemetery']
+amenities = ['cafe', 'restaurant', 'school', 'bank', 'pharmacy', None]
+
+def point(r, size=None):
+    return Point(r.uniform(0, extent), r.uniform(0, extent))
+
+def line(r, size=40):
+    x, y = r.uniform(0, extent), r.uniform(0, extent)
+    coords = [(x, y)]
+
+    for n in range(r.randint(2, size)):
+        x, y = x + r.uniform(-80, 80), y + r.uniform(-80, 80)
+        coords.append((x, y))
+
+    return LineString(coords)
+
+def polygon(r, size=40):
+    x, y = r.uniform(0, extent), r.uniform(0, extent)
+    vertices = r.randint(4, 24)
+    angles = [2 * pi * n / vertices for n in range(vertices)]
+
+    return Polygon([(x + size * r.uniform(0.6, 1) * cos(a), y + size * r.uniform(0.6, 1) * sin(a))
+                    for a in angles])
+
+def roads_props(r, n):
+    return {'source': 'osm', 'highway': r.choice(highways), 'name': r.choice(names),
+            'tunnel': r.choice([None, None, None, 'yes']), 'bridge': r.choice([None, None, None, 'yes']),
+            'oneway': r.choice([None, None, 'yes', '-1']), 'ref': None, 'z_order': r.randint(0, 40),
+            'access': None, 'service': None, 'layer': r.choice([None, None, '1', '-1'])}
+
+def buildings_props(r, n):
+    return {'name': None, 'area': r.randint(1600, 50000), 'building': r.choice(buildings),
+            'building:part': None, 'amenity': r.choice(amenities), 'shop': None, 'tourism': None,
+            'building:levels': r.choice([None, '2', '3', '12']), 'building:min_levels': None,
+            'height': r.choice([None, '10', '25 m']), 'min_height': None}
+
+def pois_props(r, n):
+    return {'name': r.choice(names), 'amenity': r.choice(amenities), 'shop': None, 'tourism': None}
+
+def places_props(r, n):
+    return {'name': 'Place %d' % n, 'place': r.choice(['city', 'town', 'village']),
+            'population': r.randint(100, 1000000), 'scalerank': r.randint(0, 10)}
+
+def landuse_props(r, n):
+    return {'name': r.choice(names), 'kind': r.choice(landuses), 'area': r.randint(1000, 1000000)}
+
+def earth_props(r, n):
+    return {'land': 'base'}
+
+def water_props(r, n):
+    return {'kind': r.choice(['ocean', 'lake', 'riverbank', 'river', 'stream']),
+            'area': r.randint(1000, 1000000), 'name': r.choice(names)}
+
+# features per tile, geometry, geometry size and properties for each layer
+densities = {'roads':          (800,  line,    40,   roads_props),
+             'buildings':      (2000, polygon, 30,   buildings_props),
+             'pois':           (300,  point,   None, pois_props),
+             'places':         (50,   point,   None, places_props),
+             'landuse':        (400,  polygon, 400,  landuse_props),
+             'landuse_labels': (200,  point,   None, landuse_props),
+             'earth':          (5,    polygon, 4000, earth_props),
+             'water':          (60,   polygon, 600,  water_props)}
+
+def synthetic_rows(layer_name, count=None, seed=0):
+    ''' Generate rows for a layer at the density of a busy city tile.
+    '''
+    default, geometry, size, props = densities.get(layer_name, densities['pois'])
+    r = random.Random('%s-%d' % (layer_name, seed))
+    rows = []
+
+    for n in range(count or default):
+        row = props(r, n)
+        row['__id__'] = n + 1
+        row['__geometry__'] = buffer(geometry(r, size).wkb)
+        rows.append(row)
+
+    return rows
+
+def recorded_rows(path):
+    ''' Load recorded rows from a JSON file, see the module documentation.
+    '''
+    data = json.load(open(path))
+
+    for rows in data.values():
+        for row in rows:
+            row['__geometry__'] = buffer(unhexlify(row['__geometry__']))
+
+    return data
+
+class ReplayCursor:
+    ''' Just enough of a psycopg2 cursor to replay rows for each executed query,
+        as dicts like a RealDictCursor, or as tuples like a plain cursor.
+    '''
+    def __init__(self, tuples=False):
+        self.rows = []
+        self.queries = []
+        self.tuples = tuples
+        self.replayed = None, None, None
+
+    def execute(self, query):
+        self.queries.append(query)
+
+        # columns and tuples are built once per set of rows, like the
+        # database would send them, so they don't count towards fetching
+        if self.replayed[0] is not self.rows:
+            columns = []
+            for row in self.rows:
+                columns += [k for k in row if k not in columns]
+            tuples = [tuple(row.get(k) for k in columns) for row in self.rows]
+            self.replayed = self.rows, [(k, ) for k in columns], tuples
+
+        self.description = self.replayed[1]
+
+    def fetchall(self):
+        if self.tuples:
+            return list(self.replayed[2])
+
+        # hand out copies, in case callers pop keys off rows
+        return [dict(row) for row in self.rows]
+
+class FakeProvider(provider.Provider):
+    def __init__(self, rows):
+        self.rows = rows
+        provider.Provider.__init__(self, {})
+
+    def connect(self):
+        self.conn = None
+        self.db = ReplayCursor()
+        self.cursor = ReplayCursor(tuples=True)
+
+    def get_features(self, layer, coord, bounds, format, quantize=True):
+        self.cursor.rows = self.rows.get(layer.name, [])
+        return provider.Provider.get_features(self, layer, coord, bounds, format, quantize)
@@ -0,0 +1,96 @@
+''' Benchmark the memory and MVT encode time of feature properties, as
+dicts per feature against values interned in a FeatureBatch.
+
+    PYTHONPATH=src:test python benchmarks/properties.py [--count N]
+
+Rows come from fakedb's synthetic rows, with every string value copied as
+psycopg2 would return it. Geometries are replaced by a single point, so the
+encode times are those of the key and value tables and feature tags:
+
+- library: mapbox_vector_tile.encode with a props dict per feature
+- dicts: mvt.encode_layers with a props dict per feature
+- batch: mvt.encode_layers with the batch's interned keys and values
+
+Memory is that of the property keys and values only, shared objects counted
+once: the dicts and their strings, against the batch's tables and tag arrays.
+
+Interning saves memory for layers with repeated values. It doesn't make
+encoding consistently faster: the encode time saved against the library
+comes from mvt.VectorTile's key and value lookups, which dicts and batches
+share, and shows for layers with many distinct values.
+'''
+
+import sys
+import time
+import argparse
+import mapbox_vector_tile
+from shapely.geometry import Point
+import tile_gen.vectiles.mvt as mvt
+import tile_gen.vectiles.batch as batch
+import fakedb
+
+def fresh(value):
+    ''' Copy a string, like every row fetched from the database holds its own.
+    '''
+    return str(bytearray(value)) if isinstance(value, str) else value
+
+def size(obj, seen):
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    total = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        total += sum(size(k, seen) + size(v, seen) for (k, v) in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        total += sum(size(v, seen) for v in obj)
+
+    return total
+
+def best(fn, iterations):
+    times = []
+    for n in range(iterations):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return 1000 * min(times)
+
+def bench_layer(name, count, iterations):
+    point = Point(1, 1).wkb
+    rows = fakedb.synthetic_rows(name, count)
+    dicts = [dict((k, fresh(v)) for (k, v) in row.items()
+                  if v is not None and k not in ('__geometry__', '__id__'))
+             for row in rows]
+
+    features = [(point, props, n) for (n, props) in enumerate(dicts)]
+    interned = batch.FeatureBatch()
+    for wkb, props, fid in features:
+        interned.append(wkb, props, fid)
+
+    tables = (interned.keys, interned.values, interned.key_index, interned.value_index,
+              interned.tags, interned.tag_offsets)
+
+    library_ms = best(lambda: mapbox_vector_tile.encode([mvt.get_feature_layer(name, features)]), iterations)
+    dicts_ms = best(lambda: mvt.encode_layers([mvt.get_feature_layer(name, features)]), iterations)
+    batch_ms = best(lambda: mvt.encode_layers([mvt.get_feature_layer(name, interned)]), iterations)
+
+    return {'features': len(features),
+            'values': len(interned.values),
+            'dicts_kb': size(dicts, set()) / 1024.,
+            'batch_kb': sum(size(t, set()) for t in tables) / 1024.,
+            'library_ms': library_ms,
+            'dicts_ms': dicts_ms,
+            'batch_ms': batch_ms}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--count', type=int, default=2000, help='features per layer')
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+
+    columns = ['features', 'values', 'dicts_kb', 'batch_kb', 'library_ms', 'dicts_ms', 'batch_ms']
+    print '%-16s' % 'layer' + ''.join('%11s' % c for c in columns)
+
+    for name in sorted(fakedb.densities):
+        result = bench_layer(name, args.count, args.iterations)
+        print '%-16s' % name + ''.join('%11d' % result[c] if isinstance(result[c], int)
+                                       else '%11.1f' % result[c] for c in columns)
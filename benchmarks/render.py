@@ -0,0 +1,187 @@
+''' Benchmark the render pipeline stage by stage, without PostGIS.
+
+Layers come from test/tile-gen.cfg, and rows from fakedb: synthetic rows at
+busy city densities, or rows recorded from a real database. Every stage of
+Provider.query and render_tile is timed separately for each layer, fetch to
+sort by the timings Provider.query reports to its metrics:
+
+- query: building the SQL with get_query()
+- fetch: executing and fetching rows from the (replaying) cursor
+- decode: parsing each row's geometry, when the layer transforms or clips it
+- transform: the layer's transform_fn, and dumping the shape back to WKB,
+  only for layers with a transform_fn
+- sort: the layer's sort_fn, only for layers with one
+- encode: encoding the layer to MVT or GeoJSON
+- save: saving the encoded tile in a Disk cache
+- render: Provider.render_tile end to end
+
+Usage:
+
+    PYTHONPATH=src:test python benchmarks/render.py --output results.json
+    PYTHONPATH=src:test python benchmarks/render.py --compare results.json
+
+With --compare, stages slower than the baseline by more than --threshold,
+and by at least --min-ms, are reported and the exit status is 1.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+from collections import defaultdict
+from tempfile import mkdtemp
+from StringIO import StringIO
+from ModestMaps.Core import Coordinate
+import tile_gen.util as u
+import tile_gen.config as config
+import tile_gen.caches as caches
+import tile_gen.metrics as metrics
+import tile_gen.vectiles.provider as provider
+import fakedb
+
+stages = ['query', 'fetch', 'decode', 'transform', 'sort', 'encode', 'save', 'render']
+provider_stages = ['fetch', 'decode', 'transform', 'sort']
+
+class Stages(metrics.Metrics):
+    ''' Sums the seconds Provider.query reports for each stage.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    def timing(self, stage, layer, zoom, seconds):
+        self.seconds[stage] += seconds
+
+def load_layers(path):
+    ''' Build Layer objects from a JSON config with dotted function paths.
+    '''
+    return config.build_layers(config.read_config(path)['layers'])
+
+def best(fn, iterations):
+    ''' Return the fastest of several runs of fn, in milliseconds, and its last result.
+    '''
+    times, result = [], None
+
+    for n in range(iterations):
+        start = time.time()
+        result = fn()
+        times.append(time.time() - start)
+
+    return 1000 * min(times), result
+
+def bench_layer(prov, cache, l, coord, format, iterations):
+    bounds = u._bounds(coord, l.srid)
+    timings = {}
+
+    # queries are looked up for the layer's last zoom with data, so null
+    # queries at the benchmark zoom don't skip the whole pipeline
+    zoom = coord.zoom if l.query(coord.zoom) else len(l.queries) - 1
+    coord = Coordinate(coord.row, coord.column, zoom)
+
+    timings['query'], query = best(lambda: provider.get_query(l, coord, bounds, format), iterations)
+
+    # the other provider stages are timed by Provider.query itself, through
+    # a recording view reporting to Stages, keeping the fastest of each
+    for n in range(iterations):
+        recorded = Stages()
+        features = prov.recording(recorded, None).get_features(l, coord, bounds, format)
+        for stage, seconds in recorded.seconds.items():
+            timings[stage] = min(timings.get(stage, seconds), seconds)
+
+    # there's no stage for functions the layer doesn't have
+    if not l.transform_fn: timings.pop('transform', None)
+    if not l.sort_fn: timings.pop('sort', None)
+
+    def encode():
+        buff = StringIO()
+        provider.encode(buff, l.name, features, coord, bounds, format)
+        return buff.getvalue()
+
+    timings['encode'], body = best(encode, iterations)
+    timings['fetch'] = timings.pop('sql', 0) + timings.get('fetch', 0)
+    timings['save'], _ = best(lambda: cache.save(body, l.name, coord, format), iterations)
+    timings['render'], _ = best(lambda: prov.render_tile([l], coord, format), iterations)
+    timings['features'] = len(features)
+    timings['bytes'] = len(body)
+
+    # Provider.query reports seconds, results are in milliseconds
+    for stage in provider_stages:
+        if stage in timings: timings[stage] *= 1000
+
+    return timings
+
+def run(args):
+    layers = load_layers(args.config)
+    names = args.layers.split(',') if args.layers else sorted(layers)
+    rows = (fakedb.recorded_rows(args.rows) if args.rows
+            else {name: fakedb.synthetic_rows(name) for name in names})
+    prov = fakedb.FakeProvider(rows)
+    coord = Coordinate(6331, 2620, args.zoom)
+    path = mkdtemp()
+    cache = caches.Disk(path, dirs='portable')
+
+    try:
+        results = {name: bench_layer(prov, cache, layers[name], coord, args.format, args.iterations)
+                   for name in names}
+    finally:
+        shutil.rmtree(path)
+
+    return {'meta': {'zoom': args.zoom,
+                     'format': args.format,
+                     'iterations': args.iterations,
+                     'rows': args.rows or 'synthetic',
+                     'python': platform.python_version()},
+            'results': results}
+
+def report(results):
+    print '%-16s' % 'ms' + ''.join('%10s' % s for s in stages)
+    for name, timings in sorted(results['results'].items()):
+        print '%-16s' % name + ''.join('%10.2f' % timings[s] if s in timings else '%10s' % '-'
+                                       for s in stages)
+
+def compare(baseline, results, threshold, min_ms):
+    ''' Print stage ratios against a baseline, and return the regressed stages.
+    '''
+    regressions = []
+    print '%-16s' % 'ratio' + ''.join('%10s' % s for s in stages)
+
+    for name, timings in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if not before: continue
+
+        ratios = [timings.get(s, 0) / before[s] if before.get(s) else 1.0 for s in stages]
+        print '%-16s' % name + ''.join('%10.2f' % r for r in ratios)
+        regressions += [(name, s, r) for (s, r) in zip(stages, ratios)
+                        if r > threshold and timings.get(s, 0) - before.get(s, 0) >= min_ms]
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default=os.path.join('test', 'tile-gen.cfg'))
+    parser.add_argument('--layers', help='comma-separated layer names, defaults to all')
+    parser.add_argument('--rows', help='JSON file of recorded rows, defaults to synthetic rows')
+    parser.add_argument('--zoom', type=int, default=14)
+    parser.add_argument('--format', default='MVT', choices=['MVT', 'JSON'])
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.10)
+    parser.add_argument('--min-ms', type=float, default=0.5)
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+
+    if args.output:
+        json.dump(results, open(args.output, 'w'), indent=2, sort_keys=True)
+
+    if args.compare:
+        regressions = compare(json.load(open(args.compare)), results, args.threshold, args.min_ms)
+        for name, stage, ratio in regressions:
+            print 'regression: %s %s is %.2fx slower' % (name, stage, ratio)
+        sys.exit(1 if regressions else 0)
@@ -34,4 +34,5 @@ setup(name = 'tile-gen',
                           'psycopg2==2.6.1',
                           'Shapely==1.5.9',
                           'StreetNames==0.1.5'],
+      extras_require = {'numpy': ['numpy']},
       cmdclass = {"repl": Repl})
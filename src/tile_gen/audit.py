@@ -0,0 +1,171 @@
+"""
+Query plan audit: run EXPLAIN on the exact SQL build_query() produces for
+every layer and zoom level, over a sample of representative tiles, and flag
+plans likely to hurt in production:
+
+- seq_scan: a sequential scan of a table.
+- no_gist: no GiST index is used at all, so the bbox filter can't be indexed.
+- over_cap: the planner estimates more rows than a tile should hold.
+
+Usage, with an initialized core.env:
+
+    import tile_gen.audit as audit
+    report = audit.audit(core.env.provider, core.env.layers.values(), range(0, 17))
+    print audit.format_report(report)
+
+Or from the command line, exiting with status 1 when any plan is flagged:
+
+    python -m tile_gen.audit tile-gen.cfg roads,water --zooms 0-16
+
+>>> plan = {'Node Type': 'Seq Scan', 'Relation Name': 'planet_osm_line', 'Plan Rows': 20000}
+>>> result = {'layer': 'roads', 'zoom': 12, 'sample': 'london', 'tile': '12/2046/1362',
+...           'plan': plan, 'flags': check_plan(plan, {}, default_max_rows)}
+>>> result['flags']
+['seq_scan:planet_osm_line', 'no_gist', 'over_cap:20000']
+>>> print format_report([result])
+layer            zoom sample     tile                  est. rows  flags
+roads              12 london     12/2046/1362              20000  seq_scan:planet_osm_line no_gist over_cap:20000
+"""
+
+import sys
+import argparse
+from math import floor
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+import tile_gen.util as u
+import tile_gen.geography as geo
+import tile_gen.vectiles.provider as provider
+
+# (name, lat, lon) of dense city centers and open water
+samples = [('london', 51.5072, -0.1276),
+           ('new-york', 40.7484, -73.9857),
+           ('tokyo', 35.6812, 139.7671),
+           ('sao-paulo', -23.5505, -46.6333),
+           ('atlantic', 30.0, -40.0)]
+
+# estimated rows per tile above which a query is flagged
+default_max_rows = 10000
+
+def sample_coord(lat, lon, zoom, srid=3857):
+    """ Return the tile containing a location at a zoom level.
+    """
+    coord = geo.get_projection(srid).locationCoordinate(Location(lat, lon)).zoomTo(zoom)
+    return Coordinate(int(floor(coord.row)), int(floor(coord.column)), zoom)
+
+def parse_zooms(spec):
+    """ Return the zoom levels of a comma-separated list of zooms and ranges.
+
+        >>> parse_zooms('0-2,14')
+        [0, 1, 2, 14]
+    """
+    zooms = []
+    for part in spec.split(','):
+        start, _, end = part.partition('-')
+        zooms.extend(range(int(start), int(end or start) + 1))
+    return zooms
+
+def plan_nodes(plan):
+    """ Yield every node of a JSON query plan.
+    """
+    yield plan
+    for child in plan.get('Plans', []):
+        for node in plan_nodes(child):
+            yield node
+
+def check_plan(plan, index_methods, max_rows):
+    """ Return the list of flags for a top-level JSON plan node.
+    """
+    nodes = list(plan_nodes(plan))
+    flags = []
+
+    for node in nodes:
+        if node['Node Type'] == 'Seq Scan':
+            flags.append('seq_scan:%s' % node.get('Relation Name'))
+
+    indexes = [n['Index Name'] for n in nodes if 'Index Name' in n]
+    if not any(index_methods.get(i) == 'gist' for i in indexes):
+        flags.append('no_gist')
+
+    if plan.get('Plan Rows', 0) > max_rows:
+        flags.append('over_cap:%d' % plan['Plan Rows'])
+
+    return flags
+
+def index_methods(prov, plans):
+    """ Map index names used in plans to their access method, ex: "gist".
+    """
+    names = set(n['Index Name'] for p in plans for n in plan_nodes(p) if 'Index Name' in n)
+    if not names: return {}
+
+    prov.db.execute('SELECT c.relname, am.amname FROM pg_class c '
+                    'JOIN pg_am am ON c.relam = am.oid WHERE c.relname = ANY(%s)',
+                    (list(names),))
+
+    return dict((r['relname'], r['amname']) for r in prov.db.fetchall())
+
+def audit(prov, layers, zooms, format='MVT', analyze=False, max_rows=None):
+    """ EXPLAIN each layer query at each zoom for every sample tile, and
+        return a list of results with flags.
+    """
+    results = []
+
+    for layer in layers:
+        for zoom in zooms:
+            if layer.is_overzoomed(zoom) or not layer.query(zoom):
+                continue
+
+            for name, lat, lon in samples:
+                coord = sample_coord(lat, lon, zoom, layer.srid)
+                bounds = u._bounds(coord, layer.srid)
+                query = provider.get_query(layer, coord, bounds, format)
+                plan = prov.explain(query, analyze)['Plan']
+
+                results.append({'layer': layer.name, 'zoom': zoom, 'sample': name,
+                                'tile': '%d/%d/%d' % (zoom, coord.column, coord.row),
+                                'plan': plan, 'sql': query,
+                                'max_rows': max_rows or layer.max_features or default_max_rows})
+
+    methods = index_methods(prov, [r['plan'] for r in results])
+
+    for result in results:
+        result['flags'] = check_plan(result['plan'], methods, result['max_rows'])
+
+    return results
+
+def format_report(results, flagged_only=True):
+    """ Format audit results as a plain text table.
+    """
+    lines = ['%-16s %4s %-10s %-18s %12s  %s' % ('layer', 'zoom', 'sample', 'tile', 'est. rows', 'flags')]
+
+    for r in results:
+        if flagged_only and not r['flags']:
+            continue
+
+        lines.append('%-16s %4d %-10s %-18s %12d  %s' % (
+            r['layer'], r['zoom'], r['sample'], r['tile'],
+            r['plan'].get('Plan Rows', 0), ' '.join(r['flags'])))
+
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='EXPLAIN layer queries over sample tiles, and flag slow plans.')
+    parser.add_argument('config', help='JSON config file')
+    parser.add_argument('layers', nargs='?', help='layer request, ex: "roads,water". Default: every layer')
+    parser.add_argument('--zooms', default='0-18', help='zoom levels, ex: "0-16" or "12,14". Default: 0-18')
+    parser.add_argument('--ext', default='mvt', help='tile format extension. Default: mvt')
+    parser.add_argument('--analyze', action='store_true', help='run EXPLAIN ANALYZE, which executes every query')
+    parser.add_argument('--max-rows', type=int, help='estimated rows per tile to flag, instead of max_features')
+    parser.add_argument('--all', action='store_true', help='list plans without flags too')
+    args = parser.parse_args(argv)
+
+    # core imports this module
+    import tile_gen.core as core
+
+    core.init_env(args.config)
+    results = core.audit_queries(args.layers, parse_zooms(args.zooms), args.ext, args.analyze, args.max_rows)
+    print format_report(results, flagged_only=not args.all)
+
+    return 1 if any(r['flags'] for r in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
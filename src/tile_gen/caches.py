@@ -38,15 +38,21 @@ Each method accepts three arguments:
 The save() method accepts an additional argument before the others:
 
 - body: raw content to save to the cache.
+
+A cache may also provide writer(), taking the same three arguments and
+returning an object whose write() saves a tile as it's streamed, see Disk.
 """
 
 import os
 import sys
 import time
 import gzip
+import errno
+import shutil
 import portalocker
 from tempfile import mkstemp
-from os.path import isdir, exists, dirname, basename, join as pathjoin
+from os.path import isdir, dirname, basename, join as pathjoin
+import tile_gen.geography as geography
 
 def get_cache_by_name(name):
     if name.lower() == 'disk': return Disk
@@ -61,7 +67,8 @@ class Disk:
               "name": "Disk",
               "path": "/tmp/stache",
               "umask": "0000",
-              "dirs": "portable"
+              "dirs": "portable",
+              "max_age": 86400
             }
 
         Extra parameters:
@@ -76,20 +83,43 @@ class Disk:
         - gzip: optional list of file formats that should be stored in a
           compressed form. Defaults to "txt", "text", "json", and "xml".
           Provide an empty list in the configuration for no compression.
+        - max_age: optional number of seconds after which a stored file is
+          considered expired and is rendered again. Defaults to no expiry.
 
         If your configuration file is loaded from a remote location, e.g.
         "http://example.com/tilestache.cfg", the path *must* be an unambiguous
         filesystem path, e.g. "file:///tmp/cache"
     """
-    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split()):
+    def __init__(self, path, umask=0022, dirs='safe', gzip='txt text json xml'.split(), max_age=None):
         self.cachepath = path
         self.umask = int(umask)
         self.dirs = dirs
         self.gzip = [format.lower() for format in gzip]
+        self.max_age = None if max_age is None else float(max_age)
+        self.madedirs = set()
+        self.lockfiles = {}
 
     def _is_compressed(self, format):
         return format.lower() in self.gzip
 
+    def _makedirs(self, dirpath):
+        """ Create a directory and its parents, once per directory.
+        """
+        if dirpath in self.madedirs:
+            return
+
+        umask_old = os.umask(self.umask)
+
+        try:
+            os.makedirs(dirpath, 0777&~self.umask)
+        except OSError, e:
+            # parent directories already exist, which is fine
+            if e.errno != errno.EEXIST: raise
+        finally:
+            os.umask(umask_old)
+
+        self.madedirs.add(dirpath)
+
     def _filepath(self, layer, coord, format):
         l = layer
         z = '%d' % coord.zoom
@@ -112,15 +142,9 @@ class Disk:
             filepath = os.sep.join( (l, z, x, y + '.' + e) )
 
         elif self.dirs == 'quadtile':
-            pad, length = 1 << 31, 1 + coord.zoom
-
-            # two binary strings, one per dimension
-            xs = bin(pad + int(coord.column))[-length:]
-            ys = bin(pad + int(coord.row))[-length:]
-
-            # interleave binary bits into plain digits, 0-3.
-            # adapted from ModestMaps.Tiles.toMicrosoft()
-            dirpath = ''.join([str(int(y+x, 2)) for (x, y) in zip(xs, ys)])
+            # one more digit than the zoom, for the columns of the 4326 grid
+            # which go up to 2 ** (zoom + 1), e.g. 0213 for 3/3/5
+            dirpath = geography.quadkey(int(coord.zoom) + 1, int(coord.column), int(coord.row))
 
             # built a list of nested directory names and a file basename
             parts = [dirpath[i:i+3] for i in range(0, len(dirpath), 3)]
@@ -142,24 +166,27 @@ class Disk:
         return self._fullpath(layer, coord, format) + '.lock'
 
     def lock(self, layer, coord, format):
-        umask_old = os.umask(self.umask)
         path = self._lockpath(layer, coord, format)
+        self._makedirs(dirname(path))
 
         try:
-            os.makedirs(os.path.dirname(path), 0777&~self.umask)
-        except OSError, e:
-            # errno=17 means that parent directories already exist, which is fine
-            if e.errno != 17: raise
-        finally:
-            os.umask(umask_old)
+            lockfile = open(path, 'w+')
+        except IOError, e:
+            # the directory was removed behind our back, make it again
+            if e.errno != errno.ENOENT: raise
+            self.madedirs.discard(dirname(path))
+            self._makedirs(dirname(path))
+            lockfile = open(path, 'w+')
+
+        portalocker.lock(lockfile, portalocker.LOCK_EX | portalocker.LOCK_NB)
 
-        self.lockfile = open(path, 'w+')
-        portalocker.lock(self.lockfile, portalocker.LOCK_EX | portalocker.LOCK_NB)
+        # kept by path, as streamed tiles hold their locks while others are rendered
+        self.lockfiles[path] = lockfile
 
     def unlock(self, layer, coord, format):
-        self.lockfile.close()
-        os.remove(self.lockfile.name)
-        self.lockfile = None
+        lockfile = self.lockfiles.pop(self._lockpath(layer, coord, format))
+        lockfile.close()
+        os.remove(lockfile.name)
 
     def remove(self, layer, coord, format):
         fullpath = self._fullpath(layer, coord, format)
@@ -170,48 +197,137 @@ class Disk:
             # errno=2 means that the file does not exist, which is fine
             if e.errno != 2: raise
 
+    def _is_expired(self, fullpath, now=None):
+        if self.max_age is None:
+            return False
+
+        return (now or time.time()) - os.path.getmtime(fullpath) > self.max_age
+
+    def keys(self):
+        """ List the layer keys with files in the cache.
+        """
+        if not isdir(self.cachepath):
+            return []
+
+        return [name for name in os.listdir(self.cachepath)
+                if not name.startswith('.') and isdir(pathjoin(self.cachepath, name))]
+
+    def remove_layer(self, layer):
+        """ Remove every file of a layer key, e.g. after its definition changed.
+        """
+        shutil.rmtree(pathjoin(self.cachepath, layer), ignore_errors=True)
+
+    def purge(self):
+        """ Remove every expired file from the cache, and return how many.
+        """
+        now, count = time.time(), 0
+
+        for key in self.keys():
+            for dirpath, dirnames, filenames in os.walk(pathjoin(self.cachepath, key)):
+                for filename in filenames:
+                    fullpath = pathjoin(dirpath, filename)
+
+                    if filename.endswith('.lock') or filename.startswith('.'):
+                        continue
+
+                    if self._is_expired(fullpath, now):
+                        os.remove(fullpath)
+                        count += 1
+
+        return count
+
     def read(self, layer, coord, format):
         fullpath = self._fullpath(layer, coord, format)
 
-        if not exists(fullpath):
+        try:
+            file = open(fullpath, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT: raise
             return None
 
-        if self._is_compressed(format):
-            return gzip.open(fullpath, 'r').read()
+        with file:
+            if self.max_age is not None and time.time() - os.fstat(file.fileno()).st_mtime > self.max_age:
+                return None
 
-        else:
-            body = open(fullpath, 'rb').read()
-            return body
+            if self._is_compressed(format):
+                return gzip.GzipFile(fileobj=file, mode='rb').read()
+
+            return file.read()
+
+    def writer(self, layer, coord, format):
+        """ Return a DiskWriter saving a tile as it's written in chunks.
+
+            >>> from tempfile import mkdtemp
+            >>> from ModestMaps.Core import Coordinate
+            >>> cache, coord = Disk(mkdtemp(), dirs='portable'), Coordinate(0, 0, 1)
+            >>> writer = cache.writer('roads', coord, 'MVT')
+            >>> writer.write('abc'); writer.write('def')
+            >>> cache.read('roads', coord, 'MVT') is None
+            True
+            >>> writer.commit()
+            >>> cache.read('roads', coord, 'MVT')
+            'abcdef'
+
+            Locks on several tiles can be held at once, e.g. by streams:
+
+            >>> cache.lock('roads', coord, 'MVT'); cache.lock('water', coord, 'MVT')
+            >>> cache.unlock('roads', coord, 'MVT'); cache.unlock('water', coord, 'MVT')
+            >>> cache.lockfiles
+            {}
+        """
+        return DiskWriter(self, layer, coord, format)
 
     def save(self, body, layer, coord, format):
-        umask_old = os.umask(self.umask)
-        fullpath = self._fullpath(layer, coord, format)
+        writer = self.writer(layer, coord, format)
+        writer.write(body)
+        writer.commit()
+
+class DiskWriter:
+    """ A tile being saved to a Disk cache, written to a temporary file next
+        to its path. The file replaces the cached one on commit(), and is
+        removed by discard() if it wasn't committed.
+    """
+    def __init__(self, cache, layer, coord, format):
+        self.fullpath = cache._fullpath(layer, coord, format)
+        dirpath = dirname(self.fullpath)
+        cache._makedirs(dirpath)
 
         try:
-            os.makedirs(dirname(fullpath), 0777&~self.umask)
+            # a temporary file next to the target keeps the rename in one directory
+            fh, self.tmp_path = mkstemp(dir=dirpath, prefix='.', suffix='.tmp')
         except OSError, e:
-            if e.errno != 17: raise
-        finally:
-            os.umask(umask_old)
+            if e.errno != errno.ENOENT: raise
+            cache.madedirs.discard(dirpath)
+            cache._makedirs(dirpath)
+            fh, self.tmp_path = mkstemp(dir=dirpath, prefix='.', suffix='.tmp')
 
-        suffix = '.' + format.lower()
-        suffix += self._is_compressed(format) and '.gz' or ''
+        os.fchmod(fh, 0666&~cache.umask)
+        self.file = os.fdopen(fh, 'wb')
+        self.out = self.file
 
-        fh, tmp_path = mkstemp(dir=self.cachepath, suffix=suffix)
+        if cache._is_compressed(format):
+            self.out = gzip.GzipFile(basename(self.fullpath), 'wb', fileobj=self.file)
 
-        if self._is_compressed(format):
-            os.close(fh)
-            tmp_file = gzip.open(tmp_path, 'w')
-            tmp_file.write(body)
-            tmp_file.close()
-        else:
-            os.write(fh, body)
-            os.close(fh)
+    def write(self, chunk):
+        self.out.write(chunk)
+
+    def _close(self):
+        if self.out is not self.file: self.out.close()
+        self.file.close()
+
+    def commit(self):
+        self._close()
+        tmp_path, self.tmp_path = self.tmp_path, None
 
         try:
-            os.rename(tmp_path, fullpath)
+            os.rename(tmp_path, self.fullpath)
         except OSError:
-            os.unlink(fullpath)
-            os.rename(tmp_path, fullpath)
+            os.unlink(self.fullpath)
+            os.rename(tmp_path, self.fullpath)
+
+    def discard(self):
+        if self.tmp_path is None: return
 
-        os.chmod(fullpath, 0666&~self.umask)
+        self._close()
+        os.remove(self.tmp_path)
+        self.tmp_path = None
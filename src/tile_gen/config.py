@@ -1,10 +1,57 @@
+""" Build the environment from a config dict, or a JSON config file.
+
+Config files are fingerprinted, layer by layer, so that reloading only
+rebuilds layers whose JSON, query files or query functions changed. Editing
+nothing but a query file rebuilds its layer:
+
+>>> import tempfile
+>>> path = tempfile.mkdtemp()
+>>> open(os.path.join(path, 'roads.pgsql'), 'w').write('SELECT way AS __geometry__ FROM roads')
+>>> json.dump({'layers': {'roads': {'queries': ['roads.pgsql']},
+...                       'water': {'queries': ['SELECT way AS __geometry__ FROM water']}}},
+...           open(os.path.join(path, 'tile-gen.cfg'), 'w'))
+>>> config_d = read_config(os.path.join(path, 'tile-gen.cfg'))
+
+reload_config() only needs the layers of the running Config, which can do
+without its database connection here:
+
+>>> class Current: pass
+>>> config = Current()
+>>> config.layers = build_layers(config_d['layers'])
+>>> config.layer_fingerprints = config_d['layer_fingerprints']
+>>> config.path = config_d['path']
+>>> config.layers['roads'].query(10)
+'SELECT way AS __geometry__ FROM roads'
+
+>>> open(os.path.join(path, 'roads.pgsql'), 'w').write('SELECT way AS __geometry__ FROM roads_z10')
+>>> reloaded_d = read_config(os.path.join(path, 'tile-gen.cfg'))
+>>> reloaded_d['fingerprint'] != config_d['fingerprint']
+True
+>>> reloaded, changed = reload_config(config, reloaded_d)
+>>> changed
+[u'roads']
+>>> reloaded.layers['roads'].query(10)
+'SELECT way AS __geometry__ FROM roads_z10'
+>>> reloaded.layers['water'] is config.layers['water']
+True
+"""
+
+import os
 import sys
+import imp
 import json
 import tile_gen.util as u
 import tile_gen.layer as layer
 import tile_gen.caches as caches
+import tile_gen.tileindex as tileindex
+import tile_gen.metrics as metrics
+import tile_gen.slowlog as slowlog
+import tile_gen.profiler as profiler
 import tile_gen.vectiles.provider as provider
 from sys import stderr
+from hashlib import sha1
+from copy import copy
+from itertools import count
 
 def build_cache(cache_d):
     _class, kwargs = None, {}
@@ -12,7 +59,7 @@ def build_cache(cache_d):
     if 'name' in cache_d:
         _class = caches.get_cache_by_name(cache_d['name'])
         if _class is caches.Disk:
-            kwargs = u.select_keys(cache_d, ['umask', 'path', 'dirs', 'gzip'])
+            kwargs = u.select_keys(cache_d, ['umask', 'path', 'dirs', 'gzip', 'max_age'])
 
     elif 'class' in cache_d:
         _class = u.load_class_path(cache_d['class'])
@@ -20,13 +67,263 @@ def build_cache(cache_d):
 
     return _class(**kwargs) if _class else None
 
+def build_metrics(metrics_d):
+    _class, kwargs = None, {}
+
+    if 'name' in metrics_d:
+        _class = metrics.get_metrics_by_name(metrics_d['name'])
+        kwargs = u.select_keys(metrics_d, ['prefix', 'host', 'port'])
+
+    elif 'class' in metrics_d:
+        _class = u.load_class_path(metrics_d['class'])
+        kwargs = metrics_d.get('kwargs', {})
+
+    return _class(**kwargs) if _class else metrics.Metrics()
+
+def build_slowlog(slowlog_d, dbinfo):
+    if slowlog_d is None: return None
+
+    kwargs = u.select_keys(slowlog_d, ['threshold', 'path', 'explain', 'max_per_minute'])
+    return slowlog.SlowLog(dbinfo, **kwargs)
+
+def build_profiler(profile_d):
+    return profiler.Profiler(**u.select_keys(profile_d or {}, ['path', 'sample']))
+
+def build_index(index_d, cache):
+    if index_d is None: return None
+
+    path = index_d.get('path')
+    if path is None and isinstance(cache, caches.Disk):
+        path = os.path.join(cache.cachepath, '.tileindex')
+
+    return tileindex.TileIndex(path, **u.select_keys(index_d, ['autosave']))
+
 def build_layer(name, layer_d): return layer.Layer(name, **layer_d)
 
+# the sizes and modification times of each module's source file, and the module loaded from it
+loaded_modules = {}
+fresh_names = count(1)
+
+def source_files(fn):
+    """ Return the files a function's code was read from: its module, or its
+        template for a Jinja macro.
+    """
+    code = getattr(getattr(fn, '_func', fn), 'func_code', None)
+    if code is None: return []
+
+    filename = code.co_filename
+    if filename.endswith('.pyc'): filename = filename[:-1]
+    return [filename]
+
+def file_stats(filenames):
+    return [(f, os.stat(f).st_size, os.stat(f).st_mtime) for f in filenames if os.path.exists(f)]
+
+def load_module(modname):
+    """ Import a module, or load a fresh copy of it when its source file
+        changed since it was first loaded.
+
+        The copy is run from the source under a new name, so the imported
+        module, and every module which imported from it, are left as they
+        were. Module-level code runs again in the copy though, and modules
+        of functions named in a config should have no import side effects,
+        e.g. calling core.init_env() like test/example.py.
+    """
+    __import__(modname)
+    module = sys.modules[modname]
+    filename = getattr(module, '__file__', None) or ''
+    if filename.endswith('.pyc'): filename = filename[:-1]
+    stats = file_stats([filename]) if filename.endswith('.py') else []
+
+    if modname not in loaded_modules:
+        loaded_modules[modname] = stats, module
+    elif loaded_modules[modname][0] != stats:
+        fresh = imp.new_module('%s_%d' % (modname, next(fresh_names)))
+        fresh.__file__ = filename
+        exec compile(open(filename).read(), filename, 'exec') in fresh.__dict__
+        loaded_modules[modname] = stats, fresh
+
+    return loaded_modules[modname][1]
+
+def load_function(fn_path):
+    """ Load a function by dotted path from its module as it is now, see
+        load_module(). Jinja macros are taken from their template as it is
+        now, which the template's environment reloads when it changed.
+
+        >>> import tempfile
+        >>> path = tempfile.mkdtemp(); sys.path.insert(0, path)
+        >>> open(os.path.join(path, 'kinds.py'), 'w').write('def kind(props): return "road"\\n')
+        >>> import kinds; load_function('kinds.kind') is kinds.kind
+        True
+        >>> open(os.path.join(path, 'kinds.py'), 'w').write('def kind(props): return "highway"\\n')
+        >>> load_function('kinds.kind')({}), kinds.kind({})
+        ('highway', 'road')
+        >>> load_function('kinds.kind') is load_function('kinds.kind')
+        True
+    """
+    modname, name = fn_path.rsplit('.', 1)
+    fn = getattr(load_module(modname), name)
+
+    # Jinja macros, whose template module names them
+    environment = getattr(fn, '_environment', None)
+    template = getattr(getattr(fn, '_func', None), 'func_globals', {}).get('name')
+    if environment is not None and template is not None:
+        fn = getattr(environment.get_template(template).module, fn.name, fn)
+
+    return fn
+
+def layer_functions(layer_d):
+    return ([layer_d[k] for k in ('query_fn', 'sort_fn') if layer_d.get(k)]
+            + list(layer_d.get('transform_fns') or []))
+
+def fingerprint(obj, path=None, functions=()):
+    """ Hash a JSON config, or part of one, e.g. a single layer.
+
+        The size and modification time of every query file found in path,
+        and of the source files of functions, are hashed too, so edited
+        queries, query functions and templates change the fingerprint.
+    """
+    files = []
+    if path is not None and isinstance(obj, dict):
+        queries = [q for q in obj.get('queries', []) if u.is_query_path(q)]
+        files += file_stats([os.path.join(path, q) for q in queries])
+
+    for fn in functions:
+        files += file_stats(source_files(fn))
+
+    return sha1(json.dumps([obj, files], sort_keys=True)).hexdigest()
+
+def resolve_layer_d(layer_d, functions):
+    """ Replace dotted class paths in a layer's JSON with the functions they
+        name, resolving each path once across layers through functions.
+    """
+    def resolve(fn):
+        if not isinstance(fn, basestring): return fn
+        if fn not in functions: functions[fn] = load_function(fn)
+        return functions[fn]
+
+    layer_d = dict(layer_d)
+    for key in ('query_fn', 'sort_fn'):
+        if key in layer_d: layer_d[key] = resolve(layer_d[key])
+    if 'transform_fns' in layer_d:
+        layer_d['transform_fns'] = map(resolve, layer_d['transform_fns'] or [])
+
+    return layer_d
+
+def read_config(path):
+    """ Read a JSON config file, ex: test/tile-gen.cfg, into a dict for Config.
+
+        Class paths are resolved, and query file names are looked up in the
+        directory of the config file first. Query files are only read once
+        their zoom level is first requested.
+    """
+    raw = json.load(open(path))
+    query_path = os.path.dirname(os.path.abspath(path))
+    functions = {}
+
+    config_d = dict(raw)
+    if 'dbinfo' not in config_d:
+        config_d['dbinfo'] = raw.get('provider', {}).get('dbinfo', {})
+
+    config_d['layers'], fingerprints = {}, {}
+    for name, layer_d in raw.get('layers', {}).iteritems():
+        resolved = resolve_layer_d(layer_d, functions)
+        resolved.setdefault('query_path', query_path)
+        config_d['layers'][name] = resolved
+        fingerprints[name] = fingerprint(layer_d, query_path, layer_functions(resolved))
+
+    # layer fingerprints cover query files and functions the JSON only names
+    config_d['path'] = path
+    config_d['fingerprint'] = fingerprint([raw, fingerprints])
+    config_d['layer_fingerprints'] = fingerprints
+    return config_d
+
 def build_layers(layers_d):
     return {k: build_layer(k, v) for k, v in layers_d.iteritems()}
 
+def build_groups(groups_d, layers):
+    """ Validate layer groups, ex: {"basemap": ["earth", "water", "roads"]}.
+    """
+    for name, members in groups_d.iteritems():
+        if name in layers or name == 'all':
+            raise ValueError('Layer group name conflicts with a layer: ' + name)
+
+        missing = [m for m in members if m not in layers]
+        if missing:
+            raise ValueError('Layer group %s has unknown layers: %s' % (name, ', '.join(missing)))
+
+    return {k: sorted(set(v)) for k, v in groups_d.iteritems()}
+
+def reload_config(config, config_d):
+    """ Build a Config from config_d which shares the provider, cache, index
+        and metrics of an existing one, and reuses its unchanged layers.
+
+        Returns the new Config and the sorted names of the layers that were
+        added, changed or removed. Only layers and groups are reloaded.
+    """
+    reloaded = copy(config)
+    fingerprints = config_d.get('layer_fingerprints', {})
+    layers = {}
+
+    for name, layer_d in config_d.get('layers', {}).iteritems():
+        fingerprint = fingerprints.get(name)
+        if name in config.layers and fingerprint and fingerprint == config.layer_fingerprints.get(name):
+            layers[name] = config.layers[name]
+        else:
+            layers[name] = build_layer(name, layer_d)
+
+    reloaded.layers             = layers
+    reloaded.groups             = build_groups(config_d.get('groups', {}), layers)
+    reloaded.path               = config_d.get('path', config.path)
+    reloaded.fingerprint        = config_d.get('fingerprint')
+    reloaded.layer_fingerprints = fingerprints
+
+    changed = set(config.layers).symmetric_difference(layers)
+    changed.update(n for n in layers if layers[n] is not config.layers.get(n))
+    return reloaded, sorted(changed)
+
 class Config:
     def __init__(self, config_d):
-        self.provider = provider.Provider(config_d.get('dbinfo', {}))
+        self.metrics  = build_metrics(config_d.get('metrics', {}))
+        self.slowlog  = build_slowlog(config_d.get('slowlog'), config_d.get('dbinfo', {}))
+        self.provider = provider.Provider(config_d.get('dbinfo', {}), self.metrics, self.slowlog)
         self.cache    = build_cache(config_d.get('cache', {}))
+        self.index    = build_index(config_d.get('index'), self.cache)
+        self.profiler = build_profiler(config_d.get('profile'))
         self.layers   = build_layers(config_d.get('layers', {}))
+        self.groups   = build_groups(config_d.get('groups', {}), self.layers)
+
+        # set when read from a file with read_config()
+        self.path               = config_d.get('path')
+        self.fingerprint        = config_d.get('fingerprint')
+        self.layer_fingerprints = config_d.get('layer_fingerprints', {})
+
+    def resolve_layers(self, spec):
+        """ Resolve a layer request into a canonical cache key and what to render.
+
+            The spec is a layer name, a group name, "all", or a comma-separated
+            list of those, ex: "roads,water". Requests resolving to the same set
+            of layers share a key: a single layer is keyed by its own name, every
+            layer by "all", and anything else by the sorted, comma-joined layer
+            names.
+        """
+        if spec in self.layers: return spec, [self.layers[spec]]
+        if spec == 'all': return spec, self.layers.values()
+
+        names = set()
+        for name in spec.split(','):
+            name = name.strip()
+
+            if not name: continue
+            elif name == 'all': names.update(self.layers)
+            elif name in self.groups: names.update(self.groups[name])
+            elif name in self.layers: names.add(name)
+            else: raise ValueError('Layer not found: ' + name)
+
+        if not names: raise ValueError('Layer not found: ' + spec)
+        if names == set(self.layers): return 'all', self.layers.values()
+        names = sorted(names)
+        return ','.join(names), [self.layers[n] for n in names]
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -1,43 +1,326 @@
 from ModestMaps.Core import Coordinate
 from functools import partial
+from multiprocessing.pool import ThreadPool
 import tile_gen.util as u
 import tile_gen.config as c
+import tile_gen.expire as e
+import tile_gen.tileindex as ti
+import tile_gen.audit as audit
+import tile_gen.workers as workers
+import tile_gen.vectiles.provider as pr
 
 env = None
 
 def init_env(config_d):
+    """ Load the environment from a config dict, or the path of a JSON config file.
+    """
     global env
+    if isinstance(config_d, basestring):
+        config_d = c.read_config(config_d)
     env = c.Config(config_d)
 
-def get_tile(layer, z, x, y, ext, ignore_cached = False):
-    if layer not in env.layers and layer != 'all': raise ValueError('Layer not found: ' + layer)
+def reload(path=None, invalidate=False):
+    """ Reload the layers of the environment from its JSON config file, and
+        return the names of the layers that were added, changed or removed.
+
+        Unchanged layers, the provider with its connection, the cache and the
+        index are kept, and the environment is swapped in one assignment.
+        Renders in flight finish with the layers they started with.
+
+        path: the JSON config file, defaults to the one the environment was
+        loaded from. Environments built from a dict raise ValueError without it.
+        invalidate: also remove the cached and indexed tiles of every layer
+        key including a changed layer, ex: "roads", "roads,water" or "all".
+    """
+    global env
+    current = env
+    path = path or current.path
+    if path is None:
+        raise ValueError('Reloading needs the path of a JSON config file, the environment was built from a dict')
+
+    config_d = c.read_config(path)
+
+    if config_d['fingerprint'] == current.fingerprint:
+        return []
+
+    reloaded, changed = c.reload_config(current, config_d)
+    current.provider.ancestors.discard_keys(lambda key: key[0] in changed)
+    env = reloaded
+
+    if invalidate and changed:
+        cache, index = reloaded.cache, reloaded.index
+        keys = set(cache.keys() if cache and hasattr(cache, 'keys') else [])
+        keys.update(index.keys() if index else [])
+
+        for key in keys:
+            if key != 'all' and not set(key.split(',')) & set(changed):
+                continue
+            if cache and hasattr(cache, 'remove_layer'): cache.remove_layer(key)
+            if index: index.drop(key)
+
+        if index and index.path: index.save()
+
+    return changed
+
+def render_tile(key, layers, coord, format, provider=None):
+    """ Render a tile, and return its body and whether the tile index took it.
+
+        provider: defaults to the environment's, see Provider.recording().
+    """
+    provider = provider or env.provider
+
+    if not env.index:
+        return provider.render_tile(layers, coord, format, key), False
+
+    body, feature_layers = provider.render(layers, coord, format, key)
+    indexed = env.index.add(key, layers, coord, format, body, feature_layers)
+
+    return body, indexed
+
+def profiled(render, key, coord, ext, profile):
+    """ Call render(), under the profiler when asked to or sampled, which
+        passes it a provider of its own, see Profiler.run().
+    """
+    if profile or env.profiler.is_sampled():
+        return env.profiler.run(env.provider, key, coord, ext, render)
+
+    return render()
+
+def get_tile(layer, z, x, y, ext, ignore_cached = False, profile = False):
+    """ Return the mimetype and body of a tile.
+
+        profile: render the tile even when cached, and write its profile,
+        see tile_gen.profiler.
+    """
+    key, layers = env.resolve_layers(layer)
 
-    provider = env.provider
     cache    = env.cache
-    layers   = env.layers.values() if layer == 'all' else [env.layers[layer]]
+    index    = env.index
     coord    = Coordinate(y, x, z)
     mimetype, format = u.get_type_by_ext(ext)
-    render_tile = partial(provider.render_tile, layers, coord, format)
+    render = partial(profiled, partial(render_tile, key, layers, coord, format), key, coord, ext, profile)
+    ignore_cached = ignore_cached or profile
+
+    if index and not ignore_cached:
+        body = index.lookup(key, coord, format)
+        if body is not None: return mimetype, body
 
     if cache:
-        cache.lock(layer, coord, format)
+        cache.lock(key, coord, format)
         try:
-            body = cache.read(layer, coord, format) if not ignore_cached else None
+            body = cache.read(key, coord, format) if not ignore_cached else None
 
             if body is None:
-                body = render_tile()
-                cache.save(body, layer, coord, format)
+                body, indexed = render()
+                if not indexed: cache.save(body, key, coord, format)
         finally:
-            cache.unlock(layer, coord, format)
+            cache.unlock(key, coord, format)
     else:
-        body = render_tile()
+        body, indexed = render()
 
     return mimetype, body
 
+def stream_tile(layer, z, x, y, ext, ignore_cached = False):
+    """ Like get_tile(), but return the body as an iterator of chunks, which
+        are sent out as each layer is rendered instead of after all of them.
+    """
+    key, layers = env.resolve_layers(layer)
+    mimetype, format = u.get_type_by_ext(ext)
+
+    return mimetype, _stream_tile(env, key, layers, Coordinate(y, x, z), format, ignore_cached)
+
+def _stream_tile(env, key, layers, coord, format, ignore_cached):
+    """ Yield the chunks of a tile, saving them to the cache as they go.
+
+        Without a tile index, chunks are written to a Disk cache and not kept:
+
+        >>> from tempfile import mkdtemp
+        >>> from tile_gen.caches import Disk
+        >>> class Provider:
+        ...     def stream(self, layers, coord, format, feature_layers=None, key=None):
+        ...         return iter(['ab', 'cd'])
+        >>> class Env:
+        ...     provider, cache, index = Provider(), Disk(mkdtemp()), None
+        >>> coord = Coordinate(0, 0, 1)
+        >>> list(_stream_tile(Env(), 'roads', [], coord, 'MVT', False))
+        ['ab', 'cd']
+        >>> Env.cache.read('roads', coord, 'MVT')
+        'abcd'
+    """
+    cache = env.cache
+    index = env.index
+
+    if index and not ignore_cached:
+        body = index.lookup(key, coord, format)
+        if body is not None:
+            yield body
+            return
+
+    if cache:
+        cache.lock(key, coord, format)
+    try:
+        body = cache.read(key, coord, format) if cache and not ignore_cached else None
+        if body is not None:
+            yield body
+            return
+
+        # chunks go straight to the cache file, and are only kept in memory
+        # while the tile may still be indexed, which needs one feature at most
+        writer = cache.writer(key, coord, format) if cache and hasattr(cache, 'writer') else None
+        classifier = ti.Classifier() if index else None
+        keep_all = cache and writer is None
+        chunks = []
+
+        try:
+            for chunk in env.provider.stream(layers, coord, format, classifier, key):
+                if writer: writer.write(chunk)
+
+                if keep_all or (classifier is not None and classifier.is_candidate()): chunks.append(chunk)
+                else: del chunks[:]
+
+                yield chunk
+
+            kind = classifier.classify(layers, format) if classifier is not None else None
+            indexed = kind is not None
+            if indexed: index.record(key, layers, coord, format, ''.join(chunks), kind)
+            elif index: index.forget(key, coord, format)
+
+            if writer and not indexed: writer.commit()
+            elif cache and not writer and not indexed: cache.save(''.join(chunks), key, coord, format)
+        finally:
+            if writer: writer.discard()
+    finally:
+        if cache:
+            cache.unlock(key, coord, format)
+
+def expire(tiles, minzoom, maxzoom, layers=None, exts=('mvt',), rerender=False, processes=None):
+    """ Invalidate, or re-render, every tile affected by a list of changed tiles.
+
+        tiles: (z, x, y) tuples, ex: e.read_tiles(open('expire.tiles')), or
+        e.affected_bbox_tiles(bboxes, minzoom, maxzoom) for changed geometries.
+        layers: layer requests to expire, defaults to every key in the cache and index.
+        rerender: render the affected tiles again instead of only removing them.
+        processes: number of worker processes or threads, defaults to cpu count.
+    """
+    cache, index = env.cache, env.index
+    tiles = list(tiles)
+
+    # overzoomed tiles are cut from cached ancestors, before forking any workers
+    e.expire_ancestors(env.provider.ancestors, tiles)
+
+    if layers is None:
+        keys = set(cache.keys() if cache and hasattr(cache, 'keys') else [])
+        keys.update(index.keys() if index else [])
+    else:
+        keys = set(env.resolve_layers(l)[0] for l in layers)
+
+    formats = {ext: u.get_type_by_ext(ext)[1] for ext in exts}
+    affected = e.affected_tiles(tiles, minzoom, maxzoom)
+    jobs = [(key, z, x, y, ext)
+            for (z, x, y) in affected
+            for key in keys
+            for ext in exts]
+
+    if index:
+        for key, z, x, y, ext in jobs:
+            index.discard(key, Coordinate(y, x, z), formats[ext])
+        if index.path: index.save()
+
+    # keys of layers no longer configured, ex: directories left in the cache,
+    # aren't rendered again, their tiles are only removed
+    renderable = set(k for k in keys if _resolves(env, k)) if rerender else set()
+    removed = [job for job in jobs if job[0] not in renderable]
+
+    if renderable:
+        pool = workers.WorkerPool(env, processes, chunksize=64)
+        try:
+            pool.render_tiles([job for job in jobs if job[0] in renderable], ignore_cached=True)
+        finally:
+            pool.close()
+
+    if cache and removed:
+        remove = lambda (key, z, x, y, ext): cache.remove(key, Coordinate(y, x, z), formats[ext])
+        pool = ThreadPool(processes)
+        try:
+            pool.map(remove, removed, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+
+    return len(jobs)
+
+def _resolves(env, key):
+    """ True when key is the canonical key of configured layers.
+    """
+    try:
+        return env.resolve_layers(key)[0] == key
+    except ValueError:
+        return False
+
+def _seed_pyramid(env, key, layers, coord, format, base_zoom):
+    """ Render and cache a tile and its descendants, and return its feature layers.
+
+        Descendants are seeded even when no layer is built from them:
+
+        >>> class Layer:
+        ...     name, pyramid = 'roads', False
+        >>> class Provider:
+        ...     def render(self, layers, coord, format, key=None):
+        ...         rendered.append((coord.zoom, coord.column, coord.row))
+        ...         return 'body', []
+        >>> class Env:
+        ...     provider, cache, index = Provider(), None, None
+        >>> rendered = []
+        >>> _seed_pyramid(Env(), 'roads', [Layer()], Coordinate(0, 0, 0), 'MVT', 2)
+        []
+        >>> len(rendered), rendered[-1]
+        (21, (0, 0, 0))
+    """
+    provider, cache, index = env.provider, env.cache, env.index
+
+    children = []
+    if coord.zoom < base_zoom:
+        children = [(dx, dy, _seed_pyramid(env, key, layers, child, format, base_zoom))
+                    for (dx, dy, child) in u.children(coord)]
+
+    if children and any(l.pyramid for l in layers):
+        feature_layers = []
+
+        for n, layer in enumerate(layers):
+            if layer.pyramid:
+                layer_children = [(dx, dy, fls[n]['features']) for (dx, dy, fls) in children]
+                features = provider.get_pyramid_features(layer, coord, format, layer_children)
+                feature_layers.append({'name': layer.name, 'features': features})
+            else:
+                feature_layers.append(provider.get_feature_layer(layer, coord, format))
+
+        body = provider.render_feature_layers(feature_layers, coord, format, key)
+    else:
+        body, feature_layers = provider.render(layers, coord, format, key)
+
+    indexed = index.add(key, layers, coord, format, body, feature_layers) if index else False
+    if cache and not indexed:
+        cache.save(body, key, coord, format)
+
+    return feature_layers
+
+def seed_pyramid(layer, z, x, y, ext, base_zoom):
+    """ Render and cache a tile and all its descendants down to base_zoom.
+
+        Tiles of layers with the pyramid flag above base_zoom are built from
+        their children's features instead of querying the database, other
+        layers are queried as usual. Tiles are rendered depth first, so only
+        the features of the tiles along the current branch are held.
+    """
+    key, layers = env.resolve_layers(layer)
+    mimetype, format = u.get_type_by_ext(ext)
+
+    _seed_pyramid(env, key, layers, Coordinate(y, x, z), format, base_zoom)
+
 def query(layer, z, x, y, ext):
     layer = env.layers[layer]
     coord = Coordinate(y, x, z)
-    bounds = u.bounds(layer.projection, coord)
+    bounds = u._bounds(coord, layer.srid)
     mimetype, format = u.get_type_by_ext(ext)
 
     return env.provider.get_features(layer, coord, bounds, format)
@@ -45,10 +328,24 @@ def query(layer, z, x, y, ext):
 def get_query(layer, z, x, y, ext):
     layer = env.layers[layer]
     coord = Coordinate(y, x, z)
-    bounds = u.bounds(layer.projection, coord)
+    bounds = u._bounds(coord, layer.srid)
     mimetype, format = u.get_type_by_ext(ext)
 
-    return env.provider.get_query(layer, coord, bounds, format)
+    return pr.get_query(layer, coord, bounds, format)
 
 def explain_analyze_query(layer, z, x, y, ext):
-    query = 'explain analyze ' + get_query(layer, z, x, y, ext)
+    query = get_query(layer, z, x, y, ext)
+
+    return env.provider.explain_analyze(query) if query else None
+
+def audit_queries(layers=None, zooms=range(0, 19), ext='mvt', analyze=False, max_rows=None):
+    """ Audit query plans of layers, defaulting to all, at each zoom level.
+    """
+    layers = env.resolve_layers(layers)[1] if layers else env.layers.values()
+    mimetype, format = u.get_type_by_ext(ext)
+
+    return audit.audit(env.provider, layers, zooms, format, analyze, max_rows)
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
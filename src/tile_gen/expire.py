@@ -0,0 +1,102 @@
+"""
+Tile expiry after data updates.
+
+Changes come in as tiles, such as the expire-tiles files written by imposm3
+diff imports (one "z/x/y" per line), or as bounding boxes of changed
+geometries. Both are expanded to every affected tile over a range of zoom
+levels: ancestors of a changed tile contain it, and descendants are
+contained by it.
+
+>>> sorted(affected_tiles([(1, 1, 0)], 0, 2))
+[(0, 0, 0), (1, 1, 0), (2, 2, 0), (2, 2, 1), (2, 3, 0), (2, 3, 1)]
+"""
+
+import tile_gen.geography as geo
+
+def read_tiles(file):
+    """ Read "z/x/y" lines into (z, x, y) tuples, skipping blank lines.
+    """
+    for line in file:
+        line = line.strip()
+
+        if line:
+            z, x, y = line.split('/')
+            yield int(z), int(x), int(y)
+
+def bbox_tiles(bounds, zoom, srid=3857):
+    """ Return the (z, x, y) tiles at zoom intersecting (xmin, ymin, xmax, ymax).
+
+        For shapely geometries, pass shape.bounds.
+    """
+    xmin, ymin, xmax, ymax = geo.bbox_tile_range(bounds, zoom, srid)
+
+    return [(zoom, x, y)
+            for x in range(xmin, xmax + 1)
+            for y in range(ymin, ymax + 1)]
+
+def affected_tiles(tiles, minzoom, maxzoom):
+    """ Expand changed (z, x, y) tiles to all affected tiles from minzoom to maxzoom.
+    """
+    affected = set()
+
+    for z, x, y in tiles:
+        for zoom in range(minzoom, maxzoom + 1):
+            if zoom <= z:
+                shift = z - zoom
+                affected.add((zoom, x >> shift, y >> shift))
+            else:
+                shift = zoom - z
+                size = 1 << shift
+                affected.update((zoom, (x << shift) + dx, (y << shift) + dy)
+                                for dx in range(size) for dy in range(size))
+
+    return affected
+
+def overlapping(tiles):
+    """ Return a function of a (z, x, y) tile telling whether it contains, or
+        lies within, any of the tiles, at any zoom level.
+
+        >>> overlaps = overlapping([(2, 1, 1)])
+        >>> overlaps((0, 0, 0)), overlaps((2, 1, 1)), overlaps((4, 5, 7)), overlaps((2, 2, 1))
+        (True, True, True, False)
+    """
+    changed = set(tiles)
+    containing = set((zoom, x >> (z - zoom), y >> (z - zoom))
+                     for (z, x, y) in changed
+                     for zoom in range(z + 1))
+
+    def overlaps((z, x, y)):
+        return ((z, x, y) in containing or
+                any((zoom, x >> (z - zoom), y >> (z - zoom)) in changed for zoom in range(z)))
+
+    return overlaps
+
+def expire_ancestors(ancestors, tiles):
+    """ Remove the ancestor features cached for overzooming, see
+        Provider.get_ancestor_features(), which overlap changed tiles.
+
+        Ancestors live at a layer's max_zoom, which can be outside the zoom
+        range being expired, so they're matched against the changed tiles.
+
+        >>> import tile_gen.util as u
+        >>> ancestors = u.LRU(8)
+        >>> ancestors.put(('roads', 14, 2620, 6331, 'MVT'), [])
+        >>> ancestors.put(('roads', 14, 2621, 6331, 'MVT'), [])
+        >>> expire_ancestors(ancestors, [(16, 10480, 25327)])
+        >>> ancestors.items.keys()
+        [('roads', 14, 2621, 6331, 'MVT')]
+    """
+    overlaps = overlapping(tiles)
+    ancestors.discard_keys(lambda key: overlaps(key[1:4]))
+
+def affected_bbox_tiles(bboxes, minzoom, maxzoom, srid=3857):
+    """ Return all affected tiles from minzoom to maxzoom for changed bounding boxes.
+    """
+    return set(tile
+               for bounds in bboxes
+               for zoom in range(minzoom, maxzoom + 1)
+               for tile in bbox_tiles(bounds, zoom, srid))
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,140 @@
+"""
+Pre-generalised source tables: copies of a full resolution table with
+simplified geometries and, optionally, fewer rows, valid for a range of zoom
+levels. A layer declares them with "tables", and uses the "!table!" token in
+its queries where the table name goes. For each zoom level the cheapest
+valid table is picked: the most simplified one whose zoom range covers the
+zoom level and whose tolerance doesn't exceed a pixel at that zoom, scaled
+by the layer's simplify_pixels. When every table covering a zoom level is
+more simplified than that, the least simplified of them is used, and zoom
+levels no table covers have no query.
+
+Example layer configuration:
+
+    "roads": {
+      "queries": ["SELECT osm_id AS __id__, way AS __geometry__, type FROM !table!"],
+      "tables": [
+        {"name": "osm_roads", "minzoom": 10},
+        {"name": "osm_roads_gen1", "source": "osm_roads", "minzoom": 7, "maxzoom": 9,
+         "tolerance": 50, "where": "type IN ('motorway', 'trunk', 'primary', 'secondary')"},
+        {"name": "osm_roads_gen0", "source": "osm_roads", "minzoom": 5, "maxzoom": 6,
+         "tolerance": 500, "where": "type IN ('motorway', 'trunk')"}
+      ]
+    }
+
+Tables with a "source" can be created or refreshed with refresh(dbinfo, tables).
+"""
+
+from psycopg2 import connect
+
+class Table:
+    def __init__(self, name, minzoom=0, maxzoom=None, tolerance=0.0, source=None, where=None, geometry='way'):
+        self.name = name
+        self.minzoom = int(minzoom)
+        self.maxzoom = None if maxzoom is None else int(maxzoom)
+        self.tolerance = float(tolerance)
+        self.source = source
+        self.where = where
+        self.geometry = geometry
+
+    def covers(self, zoom):
+        return self.minzoom <= zoom and (self.maxzoom is None or zoom <= self.maxzoom)
+
+def choose(tables, zoom, tolerance):
+    """ Return the name of the most generalised table usable at zoom, or None
+        when no table covers it.
+
+        >>> tables = [Table('full', 10), Table('gen', 5, 9, 100), Table('gen2', 5, 9, 1000)]
+        >>> [choose(tables, z, t) for (z, t) in [(4, 5000), (6, 5000), (8, 500), (9, 50), (12, 0)]]
+        [None, 'gen2', 'gen', 'gen', 'full']
+    """
+    covering = [t for t in tables if t.covers(zoom)]
+    if not covering: return None
+
+    candidates = [t for t in covering if t.tolerance <= tolerance]
+    if not candidates:
+        # coarser than the zoom level calls for, but better than no features
+        return min(covering, key=lambda t: t.tolerance).name
+
+    return max(candidates, key=lambda t: t.tolerance).name
+
+def split_name(name):
+    """ Return the (schema, table) of a table name, with None for the current schema.
+
+        >>> split_name('osm.roads'), split_name('roads')
+        (('osm', 'roads'), (None, 'roads'))
+    """
+    schema, _, table = name.rpartition('.')
+    return (schema or None), table
+
+def quote(identifier):
+    return '"%s"' % identifier.replace('"', '""')
+
+def quote_name(name):
+    """ Quote a table name, keeping its schema apart.
+
+        >>> print quote_name('osm.roads'), quote_name('roads')
+        "osm"."roads" "roads"
+    """
+    return '.'.join(quote(part) for part in split_name(name) if part is not None)
+
+def refresh_sql(table, columns):
+    """ Return the statements that rebuild a generalised table from its source,
+        swapping it in atomically.
+
+        The new table and its index are made in the table's schema, and
+        renamed with bare names, which PostgreSQL requires:
+
+        >>> for statement in refresh_sql(Table('osm.roads_z8', source='osm.roads', tolerance=50), ['osm_id', 'way']):
+        ...     print statement
+        DROP TABLE IF EXISTS "osm"."roads_z8_new"
+        CREATE TABLE "osm"."roads_z8_new" AS SELECT "osm_id", ST_SimplifyPreserveTopology("way", 50.000000000000) AS "way" FROM "osm"."roads"
+        CREATE INDEX "roads_z8_new_way_idx" ON "osm"."roads_z8_new" USING gist ("way")
+        ANALYZE "osm"."roads_z8_new"
+        DROP TABLE IF EXISTS "osm"."roads_z8"
+        ALTER TABLE "osm"."roads_z8_new" RENAME TO "roads_z8"
+        ALTER INDEX "osm"."roads_z8_new_way_idx" RENAME TO "roads_z8_way_idx"
+    """
+    schema, name = split_name(table.name)
+    in_schema = lambda bare: quote(bare) if schema is None else quote(schema) + '.' + quote(bare)
+
+    new = name + '_new'
+    index, new_index = '%s_%s_idx' % (name, table.geometry), '%s_%s_idx' % (new, table.geometry)
+    geometry = quote(table.geometry)
+    select = ', '.join([quote(c) for c in columns if c != table.geometry]
+                       + ['ST_SimplifyPreserveTopology(%s, %.12f) AS %s' % (geometry, table.tolerance, geometry)])
+    where = ' WHERE %s' % table.where if table.where else ''
+
+    return ['DROP TABLE IF EXISTS %s' % in_schema(new),
+            'CREATE TABLE %s AS SELECT %s FROM %s%s' % (in_schema(new), select, quote_name(table.source), where),
+            'CREATE INDEX %s ON %s USING gist (%s)' % (quote(new_index), in_schema(new), geometry),
+            'ANALYZE %s' % in_schema(new),
+            'DROP TABLE IF EXISTS %s' % in_schema(name),
+            'ALTER TABLE %s RENAME TO %s' % (in_schema(new), quote(name)),
+            'ALTER INDEX %s RENAME TO %s' % (in_schema(new_index), quote(index))]
+
+def refresh(dbinfo, tables):
+    """ Create or refresh every generalised table that has a source.
+    """
+    conn = connect(**dbinfo)
+
+    try:
+        for table in tables:
+            if not table.source: continue
+
+            with conn:
+                db = conn.cursor()
+                schema, name = split_name(table.source)
+                db.execute('SELECT column_name FROM information_schema.columns '
+                           'WHERE table_schema = COALESCE(%s, current_schema()) AND table_name = %s '
+                           'ORDER BY ordinal_position', (schema, name))
+                columns = [row[0] for row in db.fetchall()]
+
+                for statement in refresh_sql(table, columns):
+                    db.execute(statement)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -1,6 +1,6 @@
 from ModestMaps.Core import Point, Coordinate
 from ModestMaps.Geo import deriveTransformation, MercatorProjection, LinearProjection, Location
-from math import log as _log, pi as _pi
+from math import log as _log, pi as _pi, tan, floor
 
 class SphericalMercator(MercatorProjection):
     """ Spherical mercator projection for most commonly-used web map tile scheme.
@@ -95,3 +95,223 @@ def get_projection(srid):
     """ Retrieve a projection object by srid.
     """
     return projections[srid]
+
+#
+# Fast tile math, without Coordinate and Point objects.
+#
+# Scalar functions repeat the arithmetic of the projections above operation
+# for operation, so they return exactly the same floats. Batch functions take
+# NumPy arrays, and need the optional numpy dependency.
+#
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_diameter = 2 * _pi * 6378137
+_zoom = _log(_diameter) / _log(2)
+
+def _mercator(srid):
+    return isinstance(get_projection(srid), SphericalMercator)
+
+def tile_bounds(z, x, y, srid=3857):
+    """ Return the (xmin, ymin, xmax, ymax) bounds of a tile, like util.bounds().
+
+        >>> tile_bounds(0, 0, 0)
+        (-20037508.342789244, -20037508.342789333, 20037508.342789333, 20037508.342789244)
+        >>> tile_bounds(1, 1, 0, 4326)
+        (-89.99999999999999, 0.0, -0.0, 89.99999999999999)
+    """
+    if _mercator(srid):
+        scale = pow(2, _zoom - z)
+        return (x * scale - _diameter/2, _diameter/2 - (y + 1) * scale,
+                (x + 1) * scale - _diameter/2, _diameter/2 - y * scale)
+
+    t = projections[4326].transformation
+    scale = pow(2, 0 - z)
+    xmin, ymin = _untransform(t, x * scale, (y + 1) * scale)
+    xmax, ymax = _untransform(t, (x + 1) * scale, y * scale)
+    return xmin, ymin, xmax, ymax
+
+def _untransform(t, column, row):
+    """ Tile coordinates at zoom 0 to degrees, for the WGS84 projection.
+    """
+    x = (column*t.by - row*t.bx - t.cx*t.by + t.cy*t.bx) / (t.ax*t.by - t.ay*t.bx)
+    y = (column*t.ay - row*t.ax - t.cx*t.ay + t.cy*t.ax) / (t.bx*t.ay - t.by*t.ax)
+    return 180.0 * x / _pi, 180.0 * y / _pi
+
+def _transform(t, x, y):
+    """ Degrees to (column, row) tile coordinates at zoom 0, for the WGS84 projection.
+    """
+    x, y = _pi * x / 180.0, _pi * y / 180.0
+    return t.ax*x + t.bx*y + t.cx, t.ay*x + t.by*y + t.cy
+
+def _fractional_tile(x, y, zoom, srid):
+    """ Projected x, y to fractional (column, row) at zoom, like projCoordinate().zoomTo().
+    """
+    if _mercator(srid):
+        scale = pow(2, zoom - _zoom)
+        return (x + _diameter/2) * scale, (_diameter/2 - y) * scale
+
+    column, row = _transform(projections[4326].transformation, x, y)
+    scale = pow(2, zoom - 0)
+    return column * scale, row * scale
+
+def bbox_tile_range(bounds, zoom, srid=3857):
+    """ Return the (xmin, ymin, xmax, ymax) columns and rows of tiles at zoom
+        intersecting projected (xmin, ymin, xmax, ymax) bounds, clamped to the world.
+
+        >>> bbox_tile_range((-1, -1, 1, 1), 2)
+        (1, 1, 2, 2)
+    """
+    rows = 1 << zoom
+    columns = rows if _mercator(srid) else rows * 2
+    clamp = lambda n, count: min(max(int(floor(n)), 0), count - 1)
+
+    left, top = _fractional_tile(bounds[0], bounds[3], zoom, srid)
+    right, bottom = _fractional_tile(bounds[2], bounds[1], zoom, srid)
+
+    return (clamp(left, columns), clamp(top, rows),
+            clamp(right, columns), clamp(bottom, rows))
+
+def lonlat_tile(lon, lat, zoom, srid=3857):
+    """ Return the (column, row) of the tile at zoom containing a longitude and latitude.
+
+        >>> lonlat_tile(-122.42, 37.77, 12)
+        (655, 1583)
+    """
+    if _mercator(srid):
+        proj = projections[3857]
+        x, y = _pi * lon / 180.0, _pi * lat / 180.0
+        y = _log(tan(0.25 * _pi + 0.5 * y))
+        t = proj.transformation
+        column, row = t.ax*x + t.bx*y + t.cx, t.ay*x + t.by*y + t.cy
+    else:
+        column, row = _transform(projections[4326].transformation, lon, lat)
+
+    scale = pow(2, zoom - 0)
+    return int(floor(column * scale)), int(floor(row * scale))
+
+# bits of a byte spread to even positions, for interleaving quadkeys
+_spread = [sum(((b >> i) & 1) << (2 * i) for i in range(8)) for b in range(256)]
+
+# a byte of an interleaved quadkey as four base 4 digits
+_digits = ['%d%d%d%d' % (b >> 6, (b >> 4) & 3, (b >> 2) & 3, b & 3) for b in range(256)]
+
+def _interleave(n):
+    return (_spread[n & 0xff]
+            | _spread[(n >> 8) & 0xff] << 16
+            | _spread[(n >> 16) & 0xff] << 32
+            | _spread[(n >> 24) & 0xff] << 48)
+
+def quadkey(z, x, y):
+    """ Return the quadkey of a tile, one base 4 digit per zoom level, up to 32.
+
+        The 4326 grid has twice as many columns as rows, so the columns of
+        its eastern half need one more digit, i.e. quadkey(z + 1, x, y).
+
+        >>> quadkey(3, 3, 5)
+        '213'
+        >>> quadkey(4, 11, 5)
+        '1213'
+    """
+    key = _interleave(x) | _interleave(y) << 1
+    digits = ''.join([_digits[(key >> shift) & 0xff] for shift in (56, 48, 40, 32, 24, 16, 8, 0)])
+
+    return digits[len(digits) - z:]
+
+def quadkey_tile(key):
+    """ Return the (z, x, y) of a quadkey.
+
+        >>> quadkey_tile('213')
+        (3, 3, 5)
+    """
+    x = y = 0
+    for digit in key:
+        d = int(digit)
+        x, y = x << 1 | d & 1, y << 1 | d >> 1
+    return len(key), x, y
+
+def _require_numpy():
+    # imported here, as tile_gen.util imports this module
+    from tile_gen.util import require_numpy
+    require_numpy('Batch tile math')
+
+def tile_bounds_array(z, x, y, srid=3857):
+    """ Batch tile_bounds(): return an (n, 4) array of bounds for arrays of z, x, y.
+
+        z may be a single zoom level.
+    """
+    _require_numpy()
+    z, x, y = (numpy.asarray(a) for a in (z, x, y))
+
+    if _mercator(srid):
+        scale = numpy.power(2.0, _zoom - z)
+        return numpy.column_stack((x * scale - _diameter/2, _diameter/2 - (y + 1) * scale,
+                                   (x + 1) * scale - _diameter/2, _diameter/2 - y * scale))
+
+    t = projections[4326].transformation
+    scale = numpy.power(2.0, 0 - z)
+    xmin, ymin = _untransform(t, x * scale, (y + 1) * scale)
+    xmax, ymax = _untransform(t, (x + 1) * scale, y * scale)
+    return numpy.column_stack((xmin, ymin, xmax, ymax))
+
+def bbox_tile_range_array(bounds, zoom, srid=3857):
+    """ Batch bbox_tile_range(): return an (n, 4) integer array of column and
+        row ranges for an (n, 4) array of bounds.
+    """
+    _require_numpy()
+    bounds = numpy.asarray(bounds, dtype=numpy.float64)
+    rows = 1 << zoom
+    columns = rows if _mercator(srid) else rows * 2
+
+    left, top = _fractional_tile(bounds[:, 0], bounds[:, 3], zoom, srid)
+    right, bottom = _fractional_tile(bounds[:, 2], bounds[:, 1], zoom, srid)
+    clamp = lambda n, count: numpy.clip(numpy.floor(n), 0, count - 1).astype(numpy.int64)
+
+    return numpy.column_stack((clamp(left, columns), clamp(top, rows),
+                               clamp(right, columns), clamp(bottom, rows)))
+
+def lonlat_tile_array(lon, lat, zoom, srid=3857):
+    """ Batch lonlat_tile(): return arrays of columns and rows.
+    """
+    _require_numpy()
+    lon, lat = numpy.asarray(lon, dtype=numpy.float64), numpy.asarray(lat, dtype=numpy.float64)
+
+    if _mercator(srid):
+        t = projections[3857].transformation
+        x, y = _pi * lon / 180.0, _pi * lat / 180.0
+        y = numpy.log(numpy.tan(0.25 * _pi + 0.5 * y))
+        column, row = t.ax*x + t.bx*y + t.cx, t.ay*x + t.by*y + t.cy
+    else:
+        column, row = _transform(projections[4326].transformation, lon, lat)
+
+    scale = pow(2, zoom - 0)
+    return (numpy.floor(column * scale).astype(numpy.int64),
+            numpy.floor(row * scale).astype(numpy.int64))
+
+def quadkey_array(z, x, y):
+    """ Batch quadkey() for a single zoom level: return an array of quadkeys
+        as integers, two bits per zoom level, which sort like their strings.
+        As with quadkey(), pass z + 1 for the full column range of 4326.
+    """
+    _require_numpy()
+    x, y = numpy.asarray(x, dtype=numpy.int64), numpy.asarray(y, dtype=numpy.int64)
+    key = numpy.zeros_like(x)
+
+    for n in range(z - 1, -1, -1):
+        key = key << 2 | ((x >> n) & 1) | ((y >> n) & 1) << 1
+    return key
+
+def quadkey_tile_array(z, keys):
+    """ Batch quadkey_tile(), the inverse of quadkey_array(): return arrays of columns and rows.
+    """
+    _require_numpy()
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    x, y = numpy.zeros_like(keys), numpy.zeros_like(keys)
+
+    for n in range(z):
+        x |= ((keys >> 2 * n) & 1) << n
+        y |= ((keys >> 2 * n + 1) & 1) << n
+    return x, y
@@ -1,4 +1,26 @@
 import tile_gen.util as u
+import tile_gen.generalize as generalize
+from ModestMaps.Core import Coordinate
+
+# tolerances are precomputed for zoom levels up to this one
+max_tolerance_zoom = 30
+
+# geometry types which clipping and simplifying can leave invalid
+polygon_types = set(['Polygon', 'MultiPolygon', 'GeometryCollection'])
+
+def tolerance_table(simplify, srid, dim, pixels):
+    """ Precompute the simplification tolerance of every zoom level.
+    """
+    if simplify == 'auto':
+        widths = [u._bounds(Coordinate(0, 0, z), srid) for z in range(max_tolerance_zoom + 1)]
+        return [pixels * (xmax - xmin) / dim for (xmin, ymin, xmax, ymax) in widths]
+
+    if isinstance(simplify, list):
+        steps = sorted(dict(simplify).items())
+        return [([t for (k, t) in steps if k <= z] or [0.0])[-1]
+                for z in range(max_tolerance_zoom + 1)]
+
+    return [float(simplify)] * (max_tolerance_zoom + 1)
 
 class Layer:
     """ A Layer.
@@ -8,7 +30,8 @@ class Layer:
           queries:
             Required list of Postgres queries, one for each zoom level. The
             last query in the list is repeated for higher zoom levels, and null
-            queries indicate an empty response.
+            queries indicate an empty response. Queries may be file names,
+            which are read the first time their zoom level is requested.
 
             Query must use "__geometry__" for a column name. A query may include an
             "__id__" column, which will be used as a feature ID in GeoJSON
@@ -17,6 +40,15 @@ class Layer:
           query-fn:
             A function of zoom level that returns a query
 
+          query_path:
+            Optional directory where query file names are looked up before
+            sys.path, ex: the directory of the config file.
+
+          tables:
+            Optional list of pre-generalised source tables, see
+            tile_gen.generalize. Queries use "!table!" for the table name,
+            and the cheapest table valid at each zoom level is filled in.
+
           srid:
             Optional numeric SRID used by PostGIS.
             Default 3857.
@@ -28,6 +60,24 @@ class Layer:
             Optional boolean flag determines whether geometries are clipped to
             tile boundaries or returned in full. Default true: clip geometries.
 
+          buffer:
+            Optional number of pixels clipped geometries extend beyond the
+            tile edges. Default: 0.
+
+          validate:
+            Optional boolean flag to repair geometries with ST_MakeValid after
+            clipping and simplification, which can leave polygons invalid for
+            the geometry operations of overzooming, tile indexing and budgets.
+            Default: on for layers whose geometry_types allow polygons, at zoom
+            levels where they're clipped or simplified.
+
+          client_clip:
+            Optional boolean flag to have PostGIS return raw geometries for MVT
+            tiles, and clip, simplify and scale them in the render process
+            instead, see tile_gen.vectiles.clip. Needs numpy. Raw geometries
+            are only validated in PostGIS when validate is true, invalid ones
+            are repaired in the render process. Default false.
+
           simplify:
             Optional tolerance(s) for simplifying geometries with PostGIS's
             ST_SimplifyPreserveTopology. Accepts float or array
@@ -36,8 +86,14 @@ class Layer:
             If a key isn't present, it will search
             for one lesser than or equal to the zoom level requested. If a float
             is supplied, it will use that tolerance for all zoom levels.
+            "auto" derives the tolerance from the size of a pixel at each zoom
+            level, in units of the layer's srid, times simplify_pixels.
             Default: 0.0.
 
+          simplify_pixels:
+            Optional tolerance in pixels for "auto" simplification.
+            Default: 0.5.
+
           geometry_types:
             Optional list of geometry types that constrains the results of what
             kind of features are returned.
@@ -52,18 +108,124 @@ class Layer:
           sort_fn:
             Optional function that will be used to sort features
             fetched from the database.
+
+          max_zoom:
+            Optional maximum data zoom level. Tiles at higher zoom levels are
+            overzoomed: cut from their ancestor tile at this zoom level by
+            clipping and rescaling its features, without querying the database.
+            Default: None, always query.
+
+          pyramid:
+            Optional boolean flag allowing tiles of this layer to be built from
+            their four children when seeding with core.seed_pyramid(), for
+            layers whose queries don't change meaning across zoom levels, e.g.
+            landuse or water. Default false.
+
+          max_features:
+            Optional maximum number of features in a tile. Features beyond it
+            are dropped from the end of the sort order. Without a sort_fn or
+            geometry_types the limit is pushed down to the query as a SQL LIMIT.
+
+          max_bytes:
+            Optional maximum size of the layer encoded on its own. Larger
+            layers have their geometries simplified with growing tolerances,
+            then lose features from the end of the sort order until they fit.
     """
-    def __init__(self, name, queries=[], query_fn=None,
-                 srid=3857, dim=256, clip=True, simplify=0.0,
-                 geometry_types=None, transform_fns=None, sort_fn=None):
+    def __init__(self, name, queries=[], query_fn=None, query_path=None,
+                 srid=3857, dim=256, clip=True, buffer=0, validate=None, client_clip=False,
+                 simplify=0.0, simplify_pixels=0.5,
+                 geometry_types=None, transform_fns=None, sort_fn=None,
+                 max_zoom=None, max_features=None, max_bytes=None, tables=None,
+                 pyramid=False):
 
         self.name = name
-        self.queries = map(u.read_query, queries)
+        self.queries = list(queries)
         self.query_fn = query_fn
+        self.query_path = query_path
+        self.compiled = {}
         self.srid = int(srid)
         self.dim = dim
         self.clip = clip
-        self.simplify = dict(simplify) if isinstance(simplify, list) else float(simplify)
+        self.buffer = float(buffer)
+        self.validate = validate
+        self.client_clip = client_clip
+        self.simplify = simplify if simplify == 'auto' else (dict(simplify) if isinstance(simplify, list) else float(simplify))
+        self.simplify_pixels = float(simplify_pixels)
+        self.tolerances = tolerance_table(simplify, self.srid, dim, self.simplify_pixels)
+        self.tables = [generalize.Table(**t) for t in tables or []]
+        self.table_names = [generalize.choose(self.tables, z, t)
+                            for (z, t) in enumerate(tolerance_table('auto', self.srid, dim, float(simplify_pixels)))]
         self.geometry_types = None if geometry_types is None else set(geometry_types)
-        self.transform_fn = u.compt(*transform_fns)
+        self.transform_fn = u.compt(*transform_fns) if transform_fns else None
         self.sort_fn = sort_fn
+        self.max_zoom = None if max_zoom is None else int(max_zoom)
+        self.max_features = None if max_features is None else int(max_features)
+        self.max_bytes = None if max_bytes is None else int(max_bytes)
+        self.pyramid = pyramid
+
+    def query(self, zoom):
+        query = (self.query_fn(zoom)
+                 if self.query_fn
+                 else self.compile(min(zoom, len(self.queries) - 1)))
+
+        if query and self.tables:
+            table = u.xs_get(self.table_names, zoom, self.table_names[-1])
+            query = query.replace('!table!', table) if table else None
+
+        return query
+
+    def compile(self, n):
+        """ Return the SQL of the nth query, reading it from its file on first use.
+        """
+        if n not in self.compiled:
+            self.compiled[n] = u.read_query(self.queries[n], self.query_path)
+        return self.compiled[n]
+
+    def tolerance(self, zoom):
+        return u.xs_get(self.tolerances, zoom, self.tolerances[-1])
+
+    def is_validated(self, zoom):
+        """ Whether clipped and simplified geometries are repaired with ST_MakeValid.
+        """
+        if self.validate is not None:
+            return self.validate
+
+        polygons = self.geometry_types is None or bool(self.geometry_types & polygon_types)
+        return polygons and (self.clip or self.tolerance(zoom) > 0)
+
+    def is_overzoomed(self, zoom):
+        return self.max_zoom is not None and zoom > self.max_zoom
+
+    def is_stable_from(self, zoom):
+        """ True when tiles below zoom can only hold a subset of the features
+            of their ancestor at zoom: they are overzoomed from it, or they run
+            the same query over smaller bounding boxes.
+
+            Layers filtering by geometry_types never are: clipping can turn a
+            feature of the ancestor into a type that is filtered out, e.g. a
+            GeometryCollection, while its pieces in the descendants are kept.
+
+            >>> Layer('water', ['SELECT 1']).is_stable_from(10)
+            True
+            >>> Layer('water', ['SELECT 1'], geometry_types=['Polygon']).is_stable_from(10)
+            False
+        """
+        if self.geometry_types is not None:
+            return False
+
+        if self.max_zoom is not None and zoom >= self.max_zoom:
+            return True
+
+        if self.max_zoom is not None: last = self.max_zoom
+        elif self.query_fn is None: last = max(zoom, len(self.queries) - 1, len(self.table_names) - 1 if self.tables else 0)
+        else: return False
+
+        query = self.query(zoom)
+        if query and '!bbox!' in query:
+            return False
+
+        return all(self.query(z) == query for z in range(zoom + 1, last + 1))
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,168 @@
+"""
+Metrics record how long each stage of rendering takes, and how much data
+flows through it, per layer and zoom level. The provider reports:
+
+Timings, in seconds:
+- sql: executing a layer query
+- fetch: transferring its rows
+- decode: parsing WKB into shapely geometries
+- clip: clipping and scaling raw geometries of client_clip layers
+- transform: property and geometry transforms, and dumping back to WKB
+- sort: the layer's sort function
+- encode: encoding all layers of a tile, labeled by the tile's layer key,
+  ex: "all" or "roads,water", see Config.resolve_layers()
+
+Counts:
+- rows: rows fetched
+- dropped: rows dropped by geometry_types, or clipped away by client_clip
+- wkb_bytes: bytes of WKB received
+- features: features returned
+- tile_bytes: size of the encoded tile
+- thinned_tiles: layers cut down to max_features, or to max_bytes by dropping features
+- simplified_tiles: layers simplified to fit max_bytes
+- thinned_features: features dropped by either budget
+
+The default records nothing and costs next to nothing. Example configuration:
+
+    "metrics": {
+      "name": "Prometheus"
+    }
+
+    "metrics": {
+      "name": "StatsD",
+      "host": "localhost",
+      "port": 8125
+    }
+
+Example external metrics configuration:
+
+    "metrics": {
+      "class": "Module.Classname",
+      "kwargs": {"frob": "yes"}
+    }
+
+Metrics must provide an "enabled" attribute and these methods:
+
+- timing(stage, layer, zoom, seconds)
+- count(name, layer, zoom, value)
+"""
+
+import socket
+from collections import defaultdict
+
+def get_metrics_by_name(name):
+    if name.lower() == 'prometheus': return Prometheus
+    elif name.lower() == 'statsd': return StatsD
+    else: raise Exception('Unknown metrics: %s' % name)
+
+class Metrics:
+    """ Records nothing.
+    """
+    enabled = False
+
+    def timing(self, stage, layer, zoom, seconds):
+        pass
+
+    def count(self, name, layer, zoom, value=1):
+        pass
+
+class Prometheus(Metrics):
+    """ Aggregates metrics in memory for the Prometheus text format.
+
+        Timings become summaries with _sum and _count series, counts become
+        counters, all labeled by layer and zoom. Serve render() from an
+        HTTP endpoint for Prometheus to scrape.
+
+        >>> m = Prometheus()
+        >>> m.timing('sql', 'roads', 14, 0.25); m.timing('sql', 'roads', 14, 0.5)
+        >>> m.count('rows', 'roads', 14, 800)
+        >>> print m.render(),
+        # TYPE tile_gen_stage_seconds summary
+        tile_gen_stage_seconds_sum{stage="sql",layer="roads",zoom="14"} 0.750000
+        tile_gen_stage_seconds_count{stage="sql",layer="roads",zoom="14"} 2
+        # TYPE tile_gen_rows_total counter
+        tile_gen_rows_total{layer="roads",zoom="14"} 800
+    """
+    enabled = True
+
+    def __init__(self, prefix='tile_gen'):
+        self.prefix = prefix
+        self.timings = defaultdict(lambda: [0, 0.0])
+        self.counts = defaultdict(int)
+
+    def timing(self, stage, layer, zoom, seconds):
+        timing = self.timings[(stage, layer, zoom)]
+        timing[0] += 1
+        timing[1] += seconds
+
+    def count(self, name, layer, zoom, value=1):
+        self.counts[(name, layer, zoom)] += value
+
+    def render(self):
+        name = self.prefix + '_stage_seconds'
+        lines = ['# TYPE %s summary' % name]
+
+        for (stage, layer, zoom), (count, total) in sorted(self.timings.items()):
+            labels = '{stage="%s",layer="%s",zoom="%s"}' % (stage, layer, zoom)
+            lines.append('%s_sum%s %f' % (name, labels, total))
+            lines.append('%s_count%s %d' % (name, labels, count))
+
+        for counter in sorted(set(k[0] for k in self.counts)):
+            name = '%s_%s_total' % (self.prefix, counter)
+            lines.append('# TYPE %s counter' % name)
+
+            for (_counter, layer, zoom), value in sorted(self.counts.items()):
+                if _counter == counter:
+                    lines.append('%s{layer="%s",zoom="%s"} %d' % (name, layer, zoom, value))
+
+        return '\n'.join(lines) + '\n'
+
+class StatsD(Metrics):
+    """ Sends each metric as a StatsD packet with DogStatsD-style tags.
+
+        Packets go over UDP to host:port, or to send(packet) if given.
+
+        >>> packets = []
+        >>> m = StatsD(send=packets.append)
+        >>> m.timing('sql', 'roads', 14, 0.25); m.count('rows', 'roads', 14, 800)
+        >>> packets
+        ['tile_gen.stage.sql:250.000|ms|#layer:roads,zoom:14', 'tile_gen.rows:800|c|#layer:roads,zoom:14']
+
+        Commas separate tags, so layer keys like "roads,water" are joined by "+":
+
+        >>> m.count('rows', 'roads,water', 14, 1000); packets[-1]
+        'tile_gen.rows:1000|c|#layer:roads+water,zoom:14'
+    """
+    enabled = True
+
+    def __init__(self, host='localhost', port=8125, prefix='tile_gen', send=None):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.send = send or self._send_udp
+        self.socket = None
+
+    def _send_udp(self, packet):
+        if self.socket is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        if isinstance(packet, unicode):
+            packet = packet.encode('utf-8')
+
+        try:
+            self.socket.sendto(packet, self.address)
+        except socket.error:
+            # metrics must never break rendering
+            pass
+
+    def _tag(self, value):
+        return ('%s' % value).replace(',', '+').replace('|', '_').replace('#', '_')
+
+    def timing(self, stage, layer, zoom, seconds):
+        self.send('%s.stage.%s:%.3f|ms|#layer:%s,zoom:%s' % (self.prefix, stage, 1000 * seconds, self._tag(layer), zoom))
+
+    def count(self, name, layer, zoom, value=1):
+        self.send('%s.%s:%d|c|#layer:%s,zoom:%s' % (self.prefix, name, value, self._tag(layer), zoom))
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
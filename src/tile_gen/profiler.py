@@ -0,0 +1,150 @@
+"""
+Profiles of single tile renders, for finding what makes a tile slow without
+reproducing it by hand. A render is profiled when core.get_tile() is called
+with profile=True, or for one in every "sample" renders when configured.
+
+Each profiled render writes three files, keyed by layer, zoom, column and
+row, e.g. profiles/roads/14/2620/6331.mvt.prof:
+
+- <y>.<ext>.prof: cProfile stats, for pstats, snakeviz or flameprof
+- <y>.<ext>.txt: the stats as text, sorted by cumulative time
+- <y>.<ext>.json: total time, tile size, the SQL of every layer query and
+  the provider's per-stage timings and counts, see tile_gen.metrics
+
+A profiled render gets a view of the provider with its own metrics and
+query trace, see Provider.recording(), so renders in other threads are
+neither recorded with it nor held up by it.
+
+Example configuration:
+
+    "profile": {
+      "path": "/var/log/tile-gen/profiles",
+      "sample": 1000
+    }
+
+Extra parameters:
+- path: directory profiles are written to. Defaults to "profiles".
+- sample: optional, profile one in every N rendered tiles. Default: none,
+  only tiles requested with profile=True.
+
+>>> import tempfile
+>>> from ModestMaps.Core import Coordinate
+>>> class Provider:
+...     metrics, trace = metrics.Metrics(), None
+...     def recording(self, metrics, trace):
+...         view = Provider(); view.metrics, view.trace = metrics, trace
+...         return view
+>>> provider = Provider()
+>>> def render(provider):
+...     provider.metrics.timing('sql', 'roads', 14, 0.5)
+...     provider.trace.append({'layer': 'roads', 'zoom': 14, 'sql': 'SELECT 1'})
+...     return 'body', False
+>>> profiler = Profiler(tempfile.mkdtemp(), sample=2)
+>>> [profiler.is_sampled() for n in range(4)]
+[False, True, False, True]
+>>> profiler.run(provider, 'roads', Coordinate(6331, 2620, 14), 'mvt', render)
+('body', False)
+>>> dirname = os.path.join(profiler.path, 'roads', '14', '2620')
+>>> sorted(os.listdir(dirname))
+['6331.mvt.json', '6331.mvt.prof', '6331.mvt.txt']
+>>> summary = json.load(open(os.path.join(dirname, '6331.mvt.json')))
+>>> summary['bytes'], summary['queries'][0]['sql'], summary['timings']
+(4, u'SELECT 1', {u'roads': {u'sql': 0.5}})
+
+The shared provider's metrics are left as they were:
+
+>>> provider.metrics.enabled, provider.trace
+(False, None)
+"""
+
+import os
+import json
+import time
+import pstats
+import cProfile
+from itertools import count
+from StringIO import StringIO
+import tile_gen.metrics as metrics
+
+class Recorder(metrics.Metrics):
+    """ Records the metrics of one render, and passes them on.
+    """
+    enabled = True
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.timings = []
+        self.counts = []
+
+    def timing(self, stage, layer, zoom, seconds):
+        self.timings.append((stage, layer, zoom, seconds))
+        self.metrics.timing(stage, layer, zoom, seconds)
+
+    def count(self, name, layer, zoom, value=1):
+        self.counts.append((name, layer, zoom, value))
+        self.metrics.count(name, layer, zoom, value)
+
+def breakdown(entries):
+    """ Sum (name, layer, zoom, value) metrics by layer and name.
+    """
+    layers = {}
+    for name, layer, zoom, value in entries:
+        totals = layers.setdefault(layer or '', {})
+        totals[name] = totals.get(name, 0) + value
+    return layers
+
+class Profiler:
+    def __init__(self, path='profiles', sample=None):
+        self.path = path
+        self.sample = None if sample is None else int(sample)
+        self.renders = count(1)
+
+    def is_sampled(self):
+        return self.sample is not None and next(self.renders) % self.sample == 0
+
+    def run(self, provider, key, coord, ext, render):
+        """ Call render(provider) under cProfile with a view of the provider
+            recording this render, write its profile, and return its result.
+        """
+        recorder = Recorder(provider.metrics)
+        queries = []
+        profile = cProfile.Profile()
+
+        start = time.time()
+        result = profile.runcall(render, provider.recording(recorder, queries))
+        seconds = time.time() - start
+
+        body = result[0] if isinstance(result, tuple) else result
+        self.write(key, coord, ext, profile, {'layer': key,
+                                              'z': coord.zoom, 'x': coord.column, 'y': coord.row,
+                                              'seconds': seconds,
+                                              'bytes': len(body),
+                                              'queries': queries,
+                                              'timings': breakdown(recorder.timings),
+                                              'counts': breakdown(recorder.counts)})
+        return result
+
+    def write(self, key, coord, ext, profile, summary):
+        dirname = os.path.join(self.path, key, str(coord.zoom), str(coord.column))
+        basename = os.path.join(dirname, '%d.%s' % (coord.row, ext))
+
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # another process may have made it first
+                if not os.path.isdir(dirname): raise
+
+        profile.dump_stats(basename + '.prof')
+
+        text = StringIO()
+        pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats()
+        with open(basename + '.txt', 'w') as file:
+            file.write(text.getvalue())
+
+        with open(basename + '.json', 'w') as file:
+            json.dump(summary, file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,134 @@
+"""
+The slow tile log captures layer queries whose database time, executing and
+fetching rows, exceeds a threshold. Each entry is a JSON line with the
+layer, zoom, bounds, time taken, generated SQL and, optionally, the plan
+from EXPLAIN (ANALYZE, BUFFERS).
+
+Plans are captured on a background thread with its own database connection,
+so rendering never waits for them. Captures are rate-limited, and entries
+beyond the limit or a full queue are counted in "dropped" rather than logged.
+
+Example configuration:
+
+    "slowlog": {
+      "threshold": 0.5,
+      "path": "/var/log/tile-gen/slow.log",
+      "explain": true,
+      "max_per_minute": 6
+    }
+
+Extra parameters:
+- threshold: seconds of database time for a query to count as slow.
+  Defaults to 1.0.
+- path: optional file to append entries to. Defaults to the
+  "tile_gen.slowlog" logger.
+- explain: optional boolean, whether to capture query plans. Default true.
+- max_per_minute: optional number of entries captured per minute.
+  Defaults to 6.
+
+>>> import tempfile
+>>> path = tempfile.mktemp()
+>>> log = SlowLog({}, threshold=0.5, path=path, explain=False, max_per_minute=1)
+>>> log.is_slow(0.2), log.is_slow(0.7)
+(False, True)
+>>> log.report('SELECT 1', 'roads', 14, (0, 0, 1, 1), 0.7)
+>>> log.report('SELECT 2', 'roads', 14, (0, 0, 1, 1), 0.9)
+>>> log.dropped
+1
+>>> while not (os.path.exists(path) and open(path).read().endswith('\\n')): time.sleep(0.01)
+>>> entry = json.loads(open(path).read())
+>>> entry['sql'], entry['layer'], entry['zoom'], entry['seconds']
+(u'SELECT 1', u'roads', 14, 0.7)
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from Queue import Queue, Full
+from psycopg2 import connect
+
+logger = logging.getLogger('tile_gen.slowlog')
+
+class SlowLog:
+    def __init__(self, dbinfo, threshold=1.0, path=None, explain=True, max_per_minute=6, queue_size=16):
+        self.dbinfo = dbinfo
+        self.threshold = float(threshold)
+        self.path = path
+        self.explain = explain
+        self.max_per_minute = int(max_per_minute)
+        self.queue_size = queue_size
+        self.captured = []
+        self.dropped = 0
+        self.pid = None
+
+    def is_slow(self, seconds):
+        return seconds >= self.threshold
+
+    def _start(self):
+        # (re)start in each process, threads and connections don't survive fork
+        self.pid = os.getpid()
+        self.queue = Queue(self.queue_size)
+        self.db = None
+        thread = threading.Thread(target=self._run, name='tile-gen-slowlog')
+        thread.daemon = True
+        thread.start()
+
+    def report(self, query, layer, zoom, bounds, seconds):
+        now = time.time()
+        self.captured = [t for t in self.captured if now - t < 60]
+
+        if len(self.captured) >= self.max_per_minute:
+            self.dropped += 1
+            return
+
+        if self.pid != os.getpid():
+            self._start()
+
+        entry = {'time': now, 'layer': layer, 'zoom': zoom, 'bounds': bounds,
+                 'seconds': seconds, 'sql': query}
+
+        try:
+            self.queue.put_nowait(entry)
+            self.captured.append(now)
+        except Full:
+            self.dropped += 1
+
+    def _explain(self, query):
+        if self.db is None:
+            conn = connect(**self.dbinfo)
+            conn.set_session(readonly=True, autocommit=True)
+            self.db = conn.cursor()
+
+        self.db.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query)
+        return self.db.fetchone()[0]
+
+    def _write(self, entry):
+        line = json.dumps(entry, sort_keys=True)
+
+        if self.path:
+            with open(self.path, 'a') as file:
+                file.write(line + '\n')
+        else:
+            logger.warning(line)
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+
+            try:
+                if self.explain:
+                    entry['plan'] = self._explain(entry['sql'])
+            except Exception, e:
+                entry['error'] = str(e)
+                self.db = None
+
+            try:
+                self._write(entry)
+            except Exception:
+                logger.exception('Could not write slow tile log entry')
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,470 @@
+"""
+A tile index remembers which rendered tiles were empty or solid, so that
+later requests for them are answered with a shared static blob instead of
+running every layer query and reading or writing a cache file.
+
+- empty: no layer returned any feature.
+- solid: a single clipped polygon covering the whole tile, e.g. open ocean.
+  Only recorded for MVT, whose tile space is the same for every tile.
+
+Empty entries also record whether they hold for descendant tiles. That is
+only the case when every layer is provably unable to return a feature below
+that zoom which it didn't return for the ancestor, see Layer.is_stable_from().
+Solid entries only hold for their own tile: the slivers left uncovered grow
+with every zoom, simplification keeps more detail deeper down, and a feature
+budget may have thinned the features away from a polygon covering the tile.
+
+Tiles of each layer key, format and zoom are kept in 64x64 tile blocks of
+one byte per tile, coding the tile's entry in a palette of the block, see
+Block. A lookup reads one code at the tile's zoom and at each ancestor zoom,
+however many blobs there are. Blobs no tile refers to anymore are dropped.
+Changes are appended to a log next to the index file as they're made, which
+is flushed every "autosave" changes and when the index is closed or the
+process exits. save() compacts the log into the index file.
+
+Example configuration:
+
+    "index": {
+      "path": "/tmp/data/.tileindex",
+      "autosave": 1000
+    }
+
+Extra parameters:
+- path: optional file where the index is persisted, with its log in path +
+  ".log". Defaults to ".tileindex" in the cache directory when a Disk cache
+  is used, otherwise the index is only kept in memory.
+- autosave: optional number of changes after which the log is flushed to
+  disk. Defaults to 1000.
+
+>>> import os, tempfile
+>>> class Layer:
+...     clip = True
+...     def is_stable_from(self, zoom): return True
+>>> from ModestMaps.Core import Coordinate
+>>> path = os.path.join(tempfile.mkdtemp(), '.tileindex')
+>>> index = TileIndex(path)
+>>> index.record('water', [Layer()], Coordinate(100, 200, 10), 'MVT', 'empty body', EMPTY)
+>>> index.lookup('water', Coordinate(400, 801, 12), 'MVT')
+'empty body'
+>>> index.record('water', [Layer()], Coordinate(101, 200, 10), 'MVT', 'solid body', SOLID)
+>>> index.lookup('water', Coordinate(101, 200, 10), 'MVT')
+'solid body'
+>>> index.lookup('water', Coordinate(404, 801, 12), 'MVT') is None
+True
+>>> index.close()
+
+Changes are read back from the log, and save() compacts it:
+
+>>> index = TileIndex(path)
+>>> index.lookup('water', Coordinate(400, 801, 12), 'MVT')
+'empty body'
+>>> index.save(); os.path.getsize(path + '.log')
+0
+>>> index.discard('water', Coordinate(400, 801, 12), 'MVT')
+>>> index.discard('water', Coordinate(101, 200, 10), 'MVT')
+>>> index.close()
+>>> index = TileIndex(path)
+>>> index.lookup('water', Coordinate(400, 801, 12), 'MVT') is None
+True
+
+Discarded tiles leave neither blocks nor blobs behind:
+
+>>> index.tiles, index.blobs
+({}, {})
+"""
+
+import os
+import atexit
+import cPickle as pickle
+from array import array
+from hashlib import sha1
+from tempfile import mkstemp
+from binascii import hexlify, unhexlify
+from shapely.wkb import loads
+from shapely.geometry import box
+import tile_gen.vectiles.mvt as mvt
+
+EMPTY, SOLID = 'empty', 'solid'
+
+class Block(object):
+    """ The entries of a 64x64 block of tiles of one zoom, as a code per tile
+        into a palette of (digest, inherited) entries, 0 for no entry.
+
+        >>> block, i = Block(), Block.locate(5, 70)[1]
+        >>> block.set(i, ('abc', True))
+        >>> block.get(i), block.get(Block.locate(5, 71)[1])
+        (('abc', True), None)
+        >>> block.set(i, None); block.count
+        0
+    """
+    __slots__ = ('codes', 'palette', 'count')
+
+    def __init__(self):
+        self.codes = bytearray(4096)
+        self.palette = []
+        self.count = 0
+
+    @staticmethod
+    def locate(x, y):
+        """ Return the block and the position within it of a tile.
+        """
+        return (x >> 6, y >> 6), ((y & 63) << 6) | (x & 63)
+
+    def get(self, i):
+        code = self.codes[i]
+        return self.palette[code - 1] if code else None
+
+    def set(self, i, entry):
+        """ Set the entry of a tile, or clear it with None.
+        """
+        code = 0
+        if entry is not None:
+            if entry not in self.palette:
+                self.compact()
+                self.palette.append(entry)
+            code = self.palette.index(entry) + 1
+
+        # a byte per tile, until the palette outgrows it
+        if code > 255 and isinstance(self.codes, bytearray):
+            self.codes = array('H', self.codes)
+
+        self.count += bool(code) - bool(self.codes[i])
+        self.codes[i] = code
+
+    def compact(self):
+        """ Drop palette entries no tile of the block has anymore, when there
+            could be none left for a new one.
+        """
+        if len(self.palette) < 4096: return
+
+        used = sorted(set(self.codes) - set([0]))
+        recode = dict((code, n + 1) for (n, code) in enumerate(used))
+        self.palette = [self.palette[code - 1] for code in used]
+        self.codes = array('H', (recode.get(code, 0) for code in self.codes))
+
+class Classifier:
+    """ Classifies a tile from its feature layers as they're rendered, keeping
+        at most the geometry of one feature. Feature layers are added with
+        append(), so it can stand in for a list, see Provider.stream().
+    """
+    def __init__(self):
+        self.count = 0
+        self.wkb = None
+
+    def append(self, feature_layer):
+        features = feature_layer['features']
+
+        if self.count == 0 and len(features):
+            self.wkb = features[0][0]
+
+        self.count += len(features)
+        if self.count > 1: self.wkb = None
+
+    def is_candidate(self):
+        """ Whether the tile can still turn out empty or solid.
+        """
+        return self.count <= 1
+
+    def classify(self, layers, format, extent=mvt.extents):
+        """ Return EMPTY, SOLID or None.
+        """
+        if self.count == 0:
+            return EMPTY
+
+        if self.count > 1 or format != 'MVT' or not all(l.clip for l in layers):
+            return None
+
+        shape = loads(self.wkb)
+        if shape.type not in ('Polygon', 'MultiPolygon'):
+            return None
+
+        # clipping and rescaling in PostGIS leaves sub-pixel slivers at the edges
+        uncovered = box(0, 0, extent, extent).difference(shape).area
+        return SOLID if uncovered < 1.0 else None
+
+def classify(layers, feature_layers, format, extent=mvt.extents):
+    """ Return EMPTY, SOLID or None for a rendered list of feature layers.
+
+        >>> class Layer: clip = True
+        >>> from shapely.geometry import Point
+        >>> classify([Layer()], [{'name': 'water', 'features': []}], 'MVT')
+        'empty'
+        >>> classify([Layer()], [{'name': 'water', 'features': [(box(-8, -8, 4104, 4104).wkb, {}, 1)]}], 'MVT')
+        'solid'
+        >>> classify([Layer()], [{'name': 'pois', 'features': [(Point(1, 1).wkb, {}, 1)]}], 'MVT') is None
+        True
+    """
+    classifier = Classifier()
+    for feature_layer in feature_layers:
+        classifier.append(feature_layer)
+
+    return classifier.classify(layers, format, extent)
+
+class TileIndex:
+    def __init__(self, path=None, autosave=1000):
+        self.path = path
+        self.autosave = int(autosave)
+        self.tiles = {} # (key, format) -> {zoom: {block: Block}}
+        self.blobs = {} # blob digest -> body
+        self.refs = {}  # blob digest -> number of tiles indexed with it
+        self.log = None
+        self.pending = 0
+
+        if path:
+            self.load()
+            atexit.register(self.close)
+
+    def lookup(self, key, coord, format):
+        """ Return the indexed body for a tile, or None if it isn't known.
+        """
+        if (key, format) not in self.tiles:
+            return None
+
+        z, x, y = int(coord.zoom), int(coord.column), int(coord.row)
+
+        for zoom in range(z, -1, -1):
+            shift = z - zoom
+            entry = self._get(key, format, zoom, x >> shift, y >> shift)
+
+            if entry is not None and (zoom == z or entry[1]):
+                return self.blobs[entry[0]]
+
+        return None
+
+    def _get(self, key, format, z, x, y):
+        block, i = Block.locate(x, y)
+        blocks = self.tiles.get((key, format), {}).get(z, {})
+        return blocks[block].get(i) if block in blocks else None
+
+    def _set(self, key, format, z, x, y, entry):
+        """ Set the (digest, inherited) entry of a tile, or clear it with None.
+        """
+        block, i = Block.locate(x, y)
+        zooms = self.tiles.setdefault((key, format), {})
+        blocks = zooms.setdefault(z, {})
+        previous = blocks[block].get(i) if block in blocks else None
+
+        if entry is not None:
+            digest = entry[0]
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            blocks.setdefault(block, Block()).set(i, entry)
+        elif previous is not None:
+            blocks[block].set(i, None)
+            if not blocks[block].count: del blocks[block]
+
+        if not blocks: del zooms[z]
+        if not zooms: del self.tiles[(key, format)]
+
+        if previous is not None:
+            digest = previous[0]
+            self.refs[digest] -= 1
+            if not self.refs[digest]:
+                del self.refs[digest], self.blobs[digest]
+
+    def collect(self):
+        """ Count the tiles of every blob again, and drop the blobs of none.
+        """
+        self.refs = {}
+        for zooms in self.tiles.values():
+            for blocks in zooms.values():
+                for block in blocks.values():
+                    for code in block.codes:
+                        if not code: continue
+                        digest = block.palette[code - 1][0]
+                        self.refs[digest] = self.refs.get(digest, 0) + 1
+
+        self.blobs = dict((d, body) for (d, body) in self.blobs.items() if d in self.refs)
+
+    def add(self, key, layers, coord, format, body, feature_layers):
+        """ Index a freshly rendered tile, and return whether it was indexed.
+        """
+        kind = classify(layers, feature_layers, format)
+        if kind is None:
+            self.forget(key, coord, format)
+            return False
+
+        self.record(key, layers, coord, format, body, kind)
+        return True
+
+    def record(self, key, layers, coord, format, body, kind):
+        """ Index a tile already classified as EMPTY or SOLID, ex: by a worker process.
+        """
+        z, x, y = int(coord.zoom), int(coord.column), int(coord.row)
+        inherited = kind == EMPTY and all(l.is_stable_from(z) for l in layers)
+        digest = sha1(body).hexdigest()
+
+        if digest not in self.blobs:
+            self.blobs[digest] = body
+            self.write_log('blob', digest, hexlify(body))
+
+        self._set(key, format, z, x, y, (digest, inherited))
+        self.write_log('record', key, format, digest, int(inherited), z, x, y)
+
+    def forget(self, key, coord, format):
+        """ Forget a tile rendered with features, e.g. again after its data
+            changed. Inherited ancestor entries covering it are split into
+            entries for the rest of their descendants.
+
+            >>> class Layer:
+            ...     clip = True
+            ...     def is_stable_from(self, zoom): return True
+            >>> from ModestMaps.Core import Coordinate
+            >>> from shapely.geometry import Point
+            >>> index = TileIndex()
+            >>> index.add('pois', [Layer()], Coordinate(0, 0, 10), 'MVT', 'empty body', [{'name': 'pois', 'features': []}])
+            True
+            >>> features = [(Point(1, 1).wkb, {}, 1), (Point(2, 2).wkb, {}, 2)]
+            >>> index.add('pois', [Layer()], Coordinate(1, 0, 12), 'MVT', 'pois body', [{'name': 'pois', 'features': features}])
+            False
+            >>> [index.lookup('pois', Coordinate(y, x, z), 'MVT') for (z, x, y) in [(12, 0, 1), (13, 0, 2), (12, 0, 0), (12, 1, 1), (13, 6, 6)]]
+            [None, None, 'empty body', 'empty body', 'empty body']
+        """
+        if (key, format) not in self.tiles:
+            return
+
+        z, x, y = int(coord.zoom), int(coord.column), int(coord.row)
+        self._forget(key, format, z, x, y)
+        self.write_log('forget', key, format, z, x, y)
+
+    def _forget(self, key, format, z, x, y):
+        self._set(key, format, z, x, y, None)
+
+        for zoom in range(z - 1, -1, -1):
+            shift = z - zoom
+            entry = self._get(key, format, zoom, x >> shift, y >> shift)
+            if entry is None or not entry[1]: continue
+
+            # the siblings of the tile and of its ancestors below this one
+            for level in range(zoom + 1, z + 1):
+                px, py = x >> (z - level), y >> (z - level)
+                for sx, sy in [(px ^ 1, py), (px, py ^ 1), (px ^ 1, py ^ 1)]:
+                    if self._get(key, format, level, sx, sy) is None:
+                        self._set(key, format, level, sx, sy, entry)
+
+            self._set(key, format, zoom, x >> shift, y >> shift, None)
+
+    def discard(self, key, coord, format):
+        """ Forget a tile and every ancestor entry, e.g. after its data changed.
+        """
+        if (key, format) not in self.tiles:
+            return
+
+        z, x, y = int(coord.zoom), int(coord.column), int(coord.row)
+        self._discard(key, format, z, x, y)
+        self.write_log('discard', key, format, z, x, y)
+
+    def _discard(self, key, format, z, x, y):
+        for zoom in range(z, -1, -1):
+            shift = z - zoom
+            self._set(key, format, zoom, x >> shift, y >> shift, None)
+
+    def keys(self):
+        return set(key for (key, format) in self.tiles)
+
+    def drop(self, key):
+        """ Forget every tile of a layer key, in every format.
+        """
+        self._drop(key)
+        self.write_log('drop', key)
+
+    def _drop(self, key):
+        for k in [k for k in self.tiles if k[0] == key]:
+            del self.tiles[k]
+
+        self.collect()
+
+    def write_log(self, *fields):
+        """ Append a change to the log, flushing it every autosave changes.
+        """
+        if not self.path: return
+
+        if self.log is None:
+            self.log = open(self.path + '.log', 'a')
+
+        self.log.write('\t'.join(map(str, fields)) + '\n')
+        self.pending += 1
+
+        if self.autosave and self.pending >= self.autosave:
+            self.flush()
+
+    def replay(self, line):
+        op, args = line.split('\t', 1)
+
+        if op == 'blob':
+            digest, body = args.split('\t')
+            self.blobs[digest] = unhexlify(body)
+        elif op == 'record':
+            key, format, digest, inherited, z, x, y = args.split('\t')
+            self._set(key, format, int(z), int(x), int(y), (digest, inherited == '1'))
+        elif op == 'forget':
+            key, format, z, x, y = args.split('\t')
+            self._forget(key, format, int(z), int(x), int(y))
+        elif op == 'discard':
+            key, format, z, x, y = args.split('\t')
+            self._discard(key, format, int(z), int(x), int(y))
+        elif op == 'drop':
+            self._drop(args)
+
+    def flush(self):
+        if self.log is not None:
+            self.log.flush()
+        self.pending = 0
+
+    def close(self):
+        """ Flush and close the log, also done when the process exits.
+        """
+        self.flush()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as file:
+                try:
+                    self.tiles, self.blobs = pickle.load(file)
+                except (AttributeError, ValueError):
+                    # written by an older version, tiles are indexed again as they're rendered
+                    self.tiles, self.blobs = {}, {}
+
+        self.collect()
+
+        log_path = self.path + '.log'
+        if not os.path.exists(log_path):
+            return
+
+        # replaying changes already in the index file gives the same tiles,
+        # so the log is safe to replay if save() was interrupted
+        with open(log_path, 'r+') as file:
+            complete = 0
+            for line in file:
+                # a process killed while writing leaves an incomplete line
+                if not line.endswith('\n'): break
+                self.replay(line[:-1])
+                complete += len(line)
+
+            file.truncate(complete)
+
+        # blobs logged for tiles discarded since
+        self.collect()
+
+    def save(self):
+        """ Write the whole index to its file, and empty the log.
+        """
+        dirpath = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+        self.collect()
+        fh, tmp_path = mkstemp(dir=dirpath)
+        with os.fdopen(fh, 'wb') as file:
+            pickle.dump((self.tiles, self.blobs), file, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp_path, self.path)
+
+        self.close()
+        open(self.path + '.log', 'w').close()
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
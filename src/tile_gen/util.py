@@ -5,8 +5,14 @@ import tile_gen.geography as geo
 import ModestMaps.Core as mm
 from pprint import PrettyPrinter
 from functools import reduce
+from collections import OrderedDict
 from sys import  modules
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def pprint(x):
     pp = PrettyPrinter(indent=4)
     pp.pprint(x)
@@ -28,6 +34,13 @@ def load_class_path(classpath):
     _class = eval(objname, module.__dict__)
     return _class
 
+def require_numpy(purpose):
+    """ Raise an ImportError naming what needs the optional numpy dependency
+        when it isn't installed, ex: require_numpy('Batch tile math').
+    """
+    if numpy is None:
+        raise ImportError(purpose + ' needs numpy, see setup.py extras')
+
 def get_type_by_ext(ext):
     if ext.lower() == 'json':
         return 'application/json', 'JSON'
@@ -38,23 +51,39 @@ def get_type_by_ext(ext):
     else:
         raise ValueError(ext + " is not a valid extension")
 
-def read_query(q):
-    if q:
+def is_query_path(q):
+    """ Whether a query is a file name rather than SQL, which always has whitespace.
+    """
+    return bool(q) and not any(c.isspace() for c in q)
+
+def read_query(q, path=None):
+    """ Return the SQL of a query, reading it from a file if it's a file name.
+
+        The file is looked up relative to path first, ex: the directory of
+        the config file, then in every sys.path entry.
+    """
+    if is_query_path(q):
         try:
-            q = u.open(q).read()
+            if path and os.path.exists(os.path.join(path, q)):
+                q = __builtin__.open(os.path.join(path, q)).read()
+            else:
+                q = open(q).read()
         except IOError:
             pass
     return q
 
 def _bounds(coord, srid):
-    proj = geo.get_projection(srid)
-    ll = proj.coordinateProj(coord.down())
-    ur = proj.coordinateProj(coord.right())
-    return ll.x, ll.y, ur.x, ur.y
+    return geo.tile_bounds(coord.zoom, coord.column, coord.row, srid)
 
 def bounds(z, x, y, srid):
     return _bounds(mm.Coordinate(y, x, z), srid)
 
+def children(coord):
+    """ Return (dx, dy, child) for the four children of a tile coordinate.
+    """
+    return [(dx, dy, mm.Coordinate(2 * int(coord.row) + dy, 2 * int(coord.column) + dx, coord.zoom + 1))
+            for dy in (0, 1) for dx in (0, 1)]
+
 def comp(*fs):
     return reduce(lambda f, g: lambda x: f(g(x)), fs)
 
@@ -68,3 +97,33 @@ def xs_get(xs, ndx, default):
         return default
 
 def select_keys(m, ks): return { k: m.get(k) for k in ks if m.get(k) != None}
+
+class LRU:
+    """ Small least-recently-used mapping holding at most size items.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            return default
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def discard_keys(self, pred):
+        """ Remove every item whose key satisfies pred.
+        """
+        for key in [k for k in self.items if pred(k)]:
+            del self.items[key]
@@ -0,0 +1,160 @@
+''' Compact storage for a layer's features.
+
+A FeatureBatch holds what would otherwise be a list of (wkb, props, fid)
+tuples: property keys and values are interned once per batch and features
+keep pairs of indices into those tables, and geometries are concatenated
+into a single buffer addressed by offsets. For layers with repeated values
+this keeps thousands of small dicts and strings out of memory, ex: out of
+the overzoom cache, see benchmarks/properties.py.
+
+Iterating or indexing a batch gives lightweight views which unpack like the
+(wkb, props, fid) tuples they replace, so sort functions, encoders and other
+per-feature code keep working unchanged.
+
+>>> features = FeatureBatch()
+>>> features.append('\\x01\\x01', {'kind': 'road', 'source': 'osm'}, 7)
+>>> features.append('\\x01\\x02', {'kind': 'path', 'source': 'osm'}, 8)
+>>> wkb, props, fid = features[1]
+>>> wkb, sorted(props.items()), fid
+('\\x01\\x02', [('kind', 'path'), ('source', 'osm')], 8)
+>>> sorted(features.keys), sorted(features.values)
+(['kind', 'source'], ['osm', 'path', 'road'])
+>>> [fid for (wkb, props, fid) in features.sorted(lambda fs: fs[::-1])]
+[8, 7]
+'''
+
+from array import array
+
+class FeatureView(object):
+    ''' One feature of a batch, behaving like a (wkb, props, fid) tuple.
+    '''
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __len__(self):
+        return 3
+
+    def __iter__(self):
+        return iter(self.batch.feature(self.index))
+
+    def __getitem__(self, i):
+        return self.batch.feature(self.index)[i]
+
+    def __repr__(self):
+        return 'FeatureView(%r)' % (self.batch.feature(self.index), )
+
+class FeatureBatch(object):
+    ''' Features sharing key and value tables and one geometry buffer.
+
+        Batches made by slicing share their parent's storage, and only keep
+        their own order of feature indices.
+    '''
+    def __init__(self):
+        self.keys, self.key_index = [], {}
+        self.values, self.value_index = [], {}
+        self.tags = array('L')              # key, value index pairs
+        self.tag_offsets = array('L', [0])
+        self.geometry = bytearray()
+        self.geometry_offsets = array('L', [0])
+        self.ids = []
+        self.order = None
+
+    def intern_key(self, key):
+        index = self.key_index.get(key)
+        if index is None:
+            index = self.key_index[key] = len(self.keys)
+            self.keys.append(key)
+        return index
+
+    def intern_value(self, value):
+        # 1, 1.0 and True hash alike but are different property values
+        try:
+            vkey = value if isinstance(value, basestring) else (type(value), value)
+            index = self.value_index.get(vkey)
+        except TypeError:
+            vkey = index = None
+
+        if index is None:
+            index = len(self.values)
+            self.values.append(value)
+            if vkey is not None: self.value_index[vkey] = index
+        return index
+
+    def append(self, wkb, props, fid):
+        ''' Add a feature, which has to go before any slice of the batch.
+
+            wkb: a string, or a buffer such as a row's bytea column, copied
+            into the batch's geometry buffer.
+
+            >>> features = FeatureBatch()
+            >>> features.append(buffer('\\x00\\x01\\x02', 1), {}, 1); features.wkb(0)
+            '\\x01\\x02'
+        '''
+        tags = self.tags
+        for k, v in props.iteritems():
+            tags.append(self.intern_key(k))
+            tags.append(self.intern_value(v))
+
+        self.tag_offsets.append(len(self.tags))
+        self.geometry.extend(wkb)
+        self.geometry_offsets.append(len(self.geometry))
+        self.ids.append(fid)
+
+    def wkb(self, i):
+        # a copy, as shapely's WKB reader only takes strings
+        start, end = self.geometry_offsets[i], self.geometry_offsets[i + 1]
+        return str(buffer(self.geometry, start, end - start))
+
+    def props(self, i):
+        start, end = self.tag_offsets[i], self.tag_offsets[i + 1]
+        return dict(zip(map(self.keys.__getitem__, self.tags[start:end:2]),
+                        map(self.values.__getitem__, self.tags[start + 1:end:2])))
+
+    def feature(self, i):
+        ''' Return a feature of the underlying storage as a (wkb, props, fid) tuple.
+        '''
+        return self.wkb(i), self.props(i), self.ids[i]
+
+    def indices(self):
+        return xrange(len(self.ids)) if self.order is None else self.order
+
+    def select(self, indices):
+        ''' Return a batch of the given underlying feature indices, sharing this one's storage.
+        '''
+        batch = FeatureBatch.__new__(FeatureBatch)
+        batch.__dict__.update(self.__dict__)
+        batch.order = array('L', indices)
+        return batch
+
+    def sorted(self, sort_fn):
+        ''' Apply a sort function written for lists of (wkb, props, fid) features,
+            and return a batch of the features it returns, which may be new.
+
+            >>> features = FeatureBatch()
+            >>> features.append('\\x01', {'rank': 2}, 7); features.append('\\x02', {'rank': 1}, 8)
+            >>> def sort_fn(fs):
+            ...     return sorted(((wkb, dict(props, sorted=True), fid) for (wkb, props, fid) in fs),
+            ...                   key=lambda (wkb, props, fid): props['rank'])
+            >>> [(fid, props['sorted']) for (wkb, props, fid) in features.sorted(sort_fn)]
+            [(8, True), (7, True)]
+        '''
+        # sort keys unpack each feature several times, so unpack them only once
+        batch = FeatureBatch()
+        for wkb, props, fid in sort_fn([self.feature(i) for i in self.indices()]):
+            batch.append(wkb, props, fid)
+        return batch
+
+    def __len__(self):
+        return len(self.ids) if self.order is None else len(self.order)
+
+    def __iter__(self):
+        return (FeatureView(self, i) for i in self.indices())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if self.order is None: return self.select(xrange(*i.indices(len(self.ids))))
+            return self.select(self.order[i])
+        return FeatureView(self, self.indices()[i])
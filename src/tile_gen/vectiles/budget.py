@@ -0,0 +1,74 @@
+''' Per-layer feature and byte budgets.
+
+Features over a layer's max_features are dropped from the end of the
+layer's sort order. A layer encoded to more than max_bytes first has its
+geometries simplified with growing tolerances, then loses features from the
+end of its sort order until it fits.
+
+>>> from shapely.geometry import LineString
+>>> features = [(LineString([(0, 0), (n, 10)]).wkb, {}, n) for n in range(5)]
+>>> [fid for (wkb, props, fid) in thin(features, 2)]
+[0, 1]
+>>> size = lambda features: 100 * len(features)
+>>> len(fit(features, 250, size)[0])
+2
+'''
+
+from shapely.wkb import loads, dumps
+
+# simplification tolerances tried in turn, in tile units (4096 per tile)
+tolerances = [4, 8, 16, 32]
+
+def thin(features, max_features):
+    ''' Keep the first max_features features.
+    '''
+    return features[:max_features]
+
+def simplify(features, tolerance):
+    ''' Simplify (wkb, props, fid) features, dropping those that vanish.
+    '''
+    simplified = []
+
+    for wkb, props, fid in features:
+        shape = loads(wkb)
+
+        if shape.type not in ('Point', 'MultiPoint'):
+            shape = shape.simplify(tolerance, preserve_topology=True)
+
+            if shape.is_empty:
+                continue
+
+        simplified.append((dumps(shape), props, fid))
+
+    return simplified
+
+def fit(features, max_bytes, measure):
+    ''' Fit features into max_bytes as measured by measure(features).
+
+        Return the features and how they were reduced: None, "simplified"
+        or "thinned".
+    '''
+    size = measure(features)
+    if size <= max_bytes:
+        return features, None
+
+    for tolerance in tolerances:
+        simplified = simplify(features, tolerance)
+        size = measure(simplified)
+
+        if size <= max_bytes:
+            return simplified, 'simplified'
+
+    features = simplified
+
+    while features and size > max_bytes:
+        # shrink in proportion to the overshoot, and by at least one feature
+        count = min(len(features) - 1, int(len(features) * 0.9 * max_bytes / size))
+        features = features[:count]
+        size = measure(features)
+
+    return features, 'thinned'
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
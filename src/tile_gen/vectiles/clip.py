@@ -0,0 +1,117 @@
+''' Clipping, simplifying and scaling of raw geometries in the render process.
+
+Layers with client_clip set have PostGIS return geometries as they are
+stored, filtered by the tile's bounding box only. The render process then
+does what build_query() would have asked of the database, in the same
+order: clip to the bounds padded by the buffer and tolerance, simplify,
+trim to the buffered bounds, then scale to tile space with x growing east
+and y growing north. Invalid raw geometries are repaired first. Tile
+coordinates are quantised to whole units of the extent the way the MVT
+encoder truncates them, so tiles come out as they would from PostGIS.
+Ancestor tiles cut into overzoomed descendants keep their fractional
+coordinates, which would otherwise be magnified into steps.
+
+This moves geometry work off a shared database and onto render workers,
+which scale out. Scaling runs on NumPy arrays of each coordinate sequence,
+and needs the optional numpy dependency.
+
+>>> from shapely.geometry import LineString
+>>> fn = clipper((0, 0, 1024, 1024), extent=4096)
+>>> print fn(LineString([(-512, 512), (512.3, 512.3)]))
+LINESTRING (0 2049, 2049 2050)
+>>> fn(LineString([(2000, 2000), (3000, 3000)])) is None
+True
+>>> print clipper((0, 0, 1024, 1024), extent=4096, quantize=False)(LineString([(0, 512), (512.3, 512.3)]))
+LINESTRING (0 2048, 2049.2 2049.2)
+'''
+
+from shapely.geometry import box, Point, LineString, Polygon
+from shapely.prepared import prep
+from shapely.geos import TopologicalError
+import tile_gen.util as u
+import tile_gen.vectiles.mvt as mvt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def scale_coords(coords, origin, factor, extent, quantize=True):
+    ''' Scale and quantise a sequence of coordinates to tile space, as an (n, 2) array.
+    '''
+    xy = (numpy.asarray(coords)[:, :2] - origin) * factor
+    if not quantize:
+        return xy
+
+    # the encoder truncates x, and y once flipped to grow south
+    xy[:, 0] = numpy.trunc(xy[:, 0])
+    xy[:, 1] = extent - numpy.trunc(extent - xy[:, 1])
+    return xy
+
+def scale(shape, origin, factor, extent=mvt.extents, quantize=True):
+    ''' Scale a shape to tile space, one NumPy operation per coordinate sequence.
+    '''
+    kind = shape.geom_type
+    coords = lambda seq: scale_coords(seq.coords, origin, factor, extent, quantize)
+
+    if shape.is_empty:
+        return shape
+    elif kind == 'Point':
+        return Point(coords(shape)[0])
+    elif kind in ('LineString', 'LinearRing'):
+        return LineString(coords(shape))
+    elif kind == 'Polygon':
+        return Polygon(coords(shape.exterior), [coords(ring) for ring in shape.interiors])
+    else:
+        return type(shape)([scale(part, origin, factor, extent, quantize) for part in shape.geoms])
+
+def intersection(shape, window):
+    ''' Intersect a shape with a box, repairing the shape first if GEOS rejects it.
+    '''
+    try:
+        return shape.intersection(window)
+    except TopologicalError:
+        return shape.buffer(0).intersection(window)
+
+def clipper(bounds, extent=mvt.extents, clip=True, buffer=0, tolerance=0, quantize=True):
+    ''' Return a function taking a shape in the layer's srid to tile space,
+        or to None when nothing of it is left in the padded bounds.
+
+        bounds: (xmin, ymin, xmax, ymax) of the tile in the layer's srid.
+        buffer, tolerance: padding and simplification tolerance in srid units.
+        quantize: whether to truncate tile coordinates like the encoder.
+    '''
+    u.require_numpy('Clipping in the render process')
+
+    xmin, ymin, xmax, ymax = bounds
+    padding = buffer + tolerance
+    window = box(xmin - padding, ymin - padding, xmax + padding, ymax + padding)
+    buffered = box(xmin - buffer, ymin - buffer, xmax + buffer, ymax + buffer)
+    prepared = prep(window)
+    origin = numpy.array([xmin, ymin])
+    factor = numpy.array([extent / float(xmax - xmin), extent / float(ymax - ymin)])
+
+    def clip_fn(shape):
+        if clip and not prepared.contains(shape):
+            if not prepared.intersects(shape):
+                return None
+            shape = intersection(shape, window)
+
+        if tolerance > 0:
+            shape = shape.simplify(tolerance, preserve_topology=True)
+
+            # simplified edges may stick out of the buffered tile by the tolerance,
+            # and simplified polygons may be invalid
+            if clip and not shape.within(buffered):
+                shape = intersection(shape, buffered)
+
+        if shape.is_empty:
+            return None
+
+        return scale(shape, origin, factor, extent, quantize)
+
+    return clip_fn
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -18,8 +18,8 @@ def mercator((x, y)):
     y = log(tan(0.25 * pi + 0.5 * y))
     return 6378137 * x, 6378137 * y
 
-def write_to_file(file, geojson, zoom):
-    ''' Write GeoJSON stream to a file
+def iterencode(geojson, zoom):
+    ''' Encode GeoJSON into a stream of strings.
 
         Floating point precision in the output is truncated to six digits.
     '''
@@ -30,14 +30,20 @@ def write_to_file(file, geojson, zoom):
     for token in encoded:
         if charfloat_pat.match(token):
             # in python 2.7, we see a character followed by a float literal
-            file.write(token[0] + flt_fmt % float(token[1:]))
+            yield token[0] + flt_fmt % float(token[1:])
 
         elif float_pat.match(token):
             # in python 2.6, we see a simple float literal
-            file.write(flt_fmt % float(token))
+            yield flt_fmt % float(token)
 
         else:
-            file.write(token)
+            yield token
+
+def write_to_file(file, geojson, zoom):
+    ''' Write GeoJSON stream to a file
+    '''
+    for token in iterencode(geojson, zoom):
+        file.write(token)
 
 def decode(file):
     ''' Decode a GeoJSON file into a list of (WKB, property dict) features.
@@ -58,16 +64,15 @@ def decode(file):
 
     return features
 
-def get_feature_layer(features):
-    _features = []
-    for feature in features:
-        wkb, props, fid = feature
-        _features.append({
-            'id': fid,
+def get_feature(feature):
+    wkb, props, fid = feature
+    return {'id': fid,
             'type': 'Feature',
             'properties': props,
-            'geometry': loads(wkb).__geo_interface__
-        })
+            'geometry': loads(wkb).__geo_interface__}
+
+def get_feature_layer(features):
+    _features = map(get_feature, features)
 
     return {'type': 'FeatureCollection',
             'features': _features}
@@ -80,3 +85,56 @@ def merge(file, feature_layers, zoom):
     layers = {x['name']: get_feature_layer(x['features'])
               for x in feature_layers}
     write_to_file(file, layers, zoom)
+
+def iter_merge(names, get_features, zoom):
+    ''' Encode layers like merge(), one feature at a time.
+
+        get_features(name) is only called for each layer when its turn comes,
+        so encoded strings can be sent out while later layers are queried.
+        Given names in the order of merge()'s feature layers, the output is
+        the same, which decodes to the same JSON in any order:
+
+        >>> from StringIO import StringIO
+        >>> from shapely.geometry import Point
+        >>> features = {'roads': [(Point(1, 2).wkb, {'kind': 'path'}, 1)],
+        ...             'water': [(Point(3, 4).wkb, {}, 2)]}
+        >>> merged = StringIO()
+        >>> merge(merged, [{'name': n, 'features': features[n]} for n in ('water', 'roads')], 14)
+        >>> streamed = ''.join(iter_merge(['water', 'roads'], features.get, 14))
+        >>> streamed == merged.getvalue()
+        True
+        >>> json.loads(''.join(iter_merge(['roads', 'water'], features.get, 14))) == json.loads(streamed)
+        True
+    '''
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    # the key orders merge() gets from its dicts
+    names = list({name: None for name in names})
+    keys = list({'type': None, 'features': None})
+
+    yield '{'
+
+    for n, name in enumerate(names):
+        yield (',' if n else '') + encoder.encode(name) + ':{'
+
+        for k, key in enumerate(keys):
+            yield (',' if k else '') + encoder.encode(key) + ':'
+
+            if key == 'type':
+                yield encoder.encode('FeatureCollection')
+                continue
+
+            yield '['
+            for f, feature in enumerate(get_features(name)):
+                if f: yield ','
+                for token in iterencode(get_feature(feature), zoom):
+                    yield token
+            yield ']'
+
+        yield '}'
+
+    yield '}'
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -1,8 +1,89 @@
 import mapbox_vector_tile
+from mapbox_vector_tile import encoder
+from tile_gen.vectiles.batch import FeatureBatch
 
 # coordindates are scaled to this range within tile
 extents = 4096
 
+class Tags(object):
+    ''' Properties of a batch feature, encoded from the batch's own key and value tables.
+    '''
+    __slots__ = ('batch', 'index')
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+class VectorTile(encoder.VectorTile):
+    ''' mapbox_vector_tile's encoder, with key and value tables looked up in
+        dicts rather than by scanning lists for every property of every feature.
+        Features from a FeatureBatch are encoded from the batch's own tables,
+        without building a props dict for each.
+    '''
+    def addFeatures(self, features, layer_name=''):
+        self.key_index, self.value_index = {}, {}
+        self.batch_keys, self.batch_values = {}, {}
+        encoder.VectorTile.addFeatures(self, features, layer_name)
+
+    def _key(self, layer, k):
+        index = self.key_index.get(k)
+        if index is None:
+            index = self.key_index[k] = len(layer.keys)
+            layer.keys.append(k)
+        return index
+
+    def _value(self, layer, v):
+        # values equal in Python share an entry, except booleans and floats
+        try:
+            vkey = (isinstance(v, bool), isinstance(v, float), v)
+            index = self.value_index.get(vkey)
+        except TypeError:
+            return None
+
+        if index is None:
+            if isinstance(v, bool):
+                layer.values.add().bool_value = v
+            elif isinstance(v, str):
+                layer.values.add().string_value = unicode(v, 'utf8')
+            elif isinstance(v, unicode):
+                layer.values.add().string_value = v
+            elif isinstance(v, (int, long)):
+                layer.values.add().int_value = v
+            elif isinstance(v, float):
+                layer.values.add().double_value = v
+            else:
+                return None
+            index = self.value_index[vkey] = len(layer.values) - 1
+        return index
+
+    def _handle_attr(self, layer, feature, props):
+        if isinstance(props, Tags):
+            self._handle_tags(layer, feature, props)
+            return
+
+        for k, v in props.items():
+            if v is None: continue
+            value = self._value(layer, v)
+            if value is None: continue
+            feature.tags.append(self._key(layer, k))
+            feature.tags.append(value)
+
+    def _handle_tags(self, layer, feature, props):
+        batch, i = props.batch, props.index
+        keys = self.batch_keys.setdefault(id(batch), {})
+        values = self.batch_values.setdefault(id(batch), {})
+        tags = batch.tags
+
+        for n in xrange(batch.tag_offsets[i], batch.tag_offsets[i + 1], 2):
+            k, v = tags[n], tags[n + 1]
+            if v not in values:
+                values[v] = self._value(layer, batch.values[v])
+            if values[v] is None: continue
+            if k not in keys:
+                keys[k] = self._key(layer, batch.keys[k])
+            feature.tags.append(keys[k])
+            feature.tags.append(values[v])
+
 def decode(file):
     tile = file.read()
     data = mapbox_vector_tile.decode(tile)
@@ -11,25 +92,39 @@ def decode(file):
 def get_feature_layer(name, features):
     _features = []
 
-    for feature in features:
-        wkb, props, fid = feature
-        _features.append({
-            'id': fid,
-            'properties': props,
-            'geometry': wkb
-        })
+    if isinstance(features, FeatureBatch):
+        for i in features.indices():
+            _features.append({
+                'id': features.ids[i],
+                'properties': Tags(features, i),
+                'geometry': features.wkb(i)
+            })
+    else:
+        for feature in features:
+            wkb, props, fid = feature
+            _features.append({
+                'id': fid,
+                'properties': props,
+                'geometry': wkb
+            })
 
     return {
         'name': name or '',
         'features': _features
     }
 
+def encode_layers(layers):
+    tile = VectorTile(extents)
+    for layer in layers:
+        tile.addFeatures(layer['features'], layer['name'])
+    return tile.tile.SerializeToString()
+
 def encode(file, name, features):
     layers = [get_feature_layer(name, features)]
-    data = mapbox_vector_tile.encode(layers)
+    data = encode_layers(layers)
     file.write(data)
 
 def merge(file, feature_layers):
     layers = map(lambda x : get_feature_layer(**x), feature_layers)
-    data = mapbox_vector_tile.encode(layers)
+    data = encode_layers(layers)
     file.write(data)
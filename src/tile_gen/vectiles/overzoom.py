@@ -0,0 +1,124 @@
+''' Overzooming: cut tiles beyond a layer's maximum data zoom out of an
+ancestor tile's features, instead of querying the database again.
+
+Features are expected in the scaled tile space produced by build_query(),
+where x grows east and y grows north from 0 to the extent of the tile.
+
+>>> from ModestMaps.Core import Coordinate
+>>> from shapely.geometry import LineString
+>>> parent = Coordinate(0, 0, 1)
+>>> features = [(LineString([(0, 0), (1024, 1024)]).wkb, {'kind': 'path'}, 1)]
+>>> [(loads(wkb).bounds, props) for (wkb, props, fid) in cut(features, parent, Coordinate(1, 0, 2))]
+[((0.0, 0.0, 2048.0, 2048.0), {'kind': 'path'})]
+>>> cut(features, parent, Coordinate(0, 0, 2))
+[]
+
+Tiles are clipped to their bounds padded by the layer's buffer, in units of
+the extent like the tiles rendered by PostGIS. Collections left by clipping
+are split into a shape per kind, and parts of a lesser dimension than the
+feature, i.e. edges and corners it shares with the tile, are dropped:
+
+>>> from shapely.geometry import Polygon
+>>> shape = Polygon([(0, 0), (1024, 0), (1024, 2560), (512, 2560), (512, 2048), (0, 2048)])
+>>> features = [(shape.wkb, {'kind': 'park'}, 2)]
+>>> [loads(wkb).bounds for (wkb, props, fid) in cut(features, parent, Coordinate(1, 0, 2), buffer=64)]
+[(0.0, 0.0, 2048.0, 4160.0)]
+>>> [loads(wkb).type for (wkb, props, fid) in cut(features, parent, Coordinate(0, 0, 2))]
+['Polygon']
+'''
+
+from shapely.wkb import loads, dumps
+from shapely.geometry import box, MultiPoint, MultiLineString, MultiPolygon
+from shapely.prepared import prep
+from shapely.affinity import affine_transform
+from ModestMaps.Core import Coordinate
+import tile_gen.vectiles.mvt as mvt
+
+def ancestor(coord, zoom):
+    ''' Return the ancestor of a coordinate at a lesser zoom level.
+    '''
+    shift = int(coord.zoom) - zoom
+    return Coordinate(int(coord.row) >> shift, int(coord.column) >> shift, zoom)
+
+def window(parent, coord, extent=mvt.extents):
+    ''' Return (xmin, ymin, size) of a descendant tile in the parent's tile space.
+    '''
+    shift = int(coord.zoom) - int(parent.zoom)
+    count = 1 << shift
+    size = float(extent) / count
+    dx = int(coord.column) - (int(parent.column) << shift)
+    dy = int(coord.row) - (int(parent.row) << shift)
+
+    # rows count down from the north edge, tile space counts up from the south
+    return dx * size, (count - 1 - dy) * size, size
+
+multi_types = {'Point': MultiPoint, 'LineString': MultiLineString, 'Polygon': MultiPolygon}
+dimensions = {'Point': 0, 'LineString': 1, 'Polygon': 2}
+
+def dimension(shape):
+    return dimensions.get(shape.type.replace('Multi', ''))
+
+def parts(shape):
+    ''' Split a geometry collection into one shape per kind of geometry in it.
+
+        >>> from shapely.geometry import GeometryCollection, LineString, Point
+        >>> shape = GeometryCollection([box(0, 0, 1, 1), Point(2, 2), box(3, 3, 4, 4), LineString([(1, 1), (3, 3)])])
+        >>> [part.type for part in parts(shape)]
+        ['LineString', 'Point', 'MultiPolygon']
+    '''
+    if shape.type != 'GeometryCollection':
+        return [shape]
+
+    kinds = {}
+    for part in shape.geoms:
+        for single in getattr(part, 'geoms', [part]):
+            kinds.setdefault(single.type, []).append(single)
+
+    return [singles[0] if len(singles) == 1 else multi_types[kind](singles)
+            for (kind, singles) in sorted(kinds.items())]
+
+def cut(features, parent, coord, clip=True, geometry_types=None, extent=mvt.extents, index=None, buffer=0):
+    ''' Clip and rescale an ancestor's (wkb, props, fid) features to a descendant tile.
+
+        index: optional spatial.GridIndex of the features, so that only those
+        near the descendant tile are decoded.
+        buffer: padding of the descendant tile when clipping, in units of the extent.
+    '''
+    xmin, ymin, size = window(parent, coord, extent)
+    padding = buffer * size / extent
+    bbox = box(xmin, ymin, xmin + size, ymin + size)
+    buffered = box(xmin - padding, ymin - padding, xmin + size + padding, ymin + size + padding)
+    prepared, prepared_buffered = prep(bbox), prep(buffered)
+    factor = extent / size
+    matrix = [factor, 0, 0, factor, -xmin * factor, -ymin * factor]
+    _features = []
+
+    if index is not None:
+        features = [features[n] for n in index.query(bbox.bounds)]
+
+    for wkb, props, fid in features:
+        shape = loads(wkb)
+
+        # like the bbox filter of queries, which leaves out the buffer
+        if not prepared.intersects(shape):
+            continue
+
+        if clip and not prepared_buffered.contains(shape):
+            clipped = shape.intersection(buffered)
+            shapes = [part for part in parts(clipped)
+                      if not part.is_empty and dimension(part) >= dimension(shape)]
+
+            if geometry_types is not None:
+                shapes = [part for part in shapes if part.type in geometry_types]
+        else:
+            shapes = [shape]
+
+        for shape in shapes:
+            shape = affine_transform(shape, matrix)
+            _features.append((dumps(shape), props, fid))
+
+    return _features
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
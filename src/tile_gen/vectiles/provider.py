@@ -1,8 +1,18 @@
+import copy
 import json
+import time
 import shapely.wkb
 import tile_gen.util as u
+import tile_gen.metrics as metrics
 import tile_gen.vectiles.mvt as mvt
 import tile_gen.vectiles.geojson as geojson
+import tile_gen.vectiles.overzoom as overzoom
+import tile_gen.vectiles.budget as budget
+import tile_gen.vectiles.clip as clip
+import tile_gen.vectiles.pyramid as pyramid
+import tile_gen.vectiles.spatial as spatial
+import tile_gen.vectiles.wkb as wkbs
+import tile_gen.vectiles.batch as batch
 from tile_gen.geography import SphericalMercator
 from ModestMaps.Core import Coordinate
 from StringIO import StringIO
@@ -11,10 +21,6 @@ from psycopg2.extras import RealDictCursor
 from psycopg2 import connect
 from ModestMaps.Core import Point
 
-def get_tolerance(simplify, zoom):
-    return (simplify[max(filter(lambda k : k <= zoom, simplify.keys()))]
-            if isinstance(simplify, dict) else simplify)
-
 def pad(bounds, padding):
     return (bounds[0] - padding,
             bounds[1] - padding,
@@ -29,11 +35,46 @@ def st_bbox(bounds, srid):
                    ymax=bounds[3],
                    srid=srid)
 
-def st_simplify(geom, tolerance, bounds, srid=3857):
-    padding = (bounds[3] - bounds[1]) * 0.1
-    geom = 'ST_Intersection(%s, %s)' % (geom, st_bbox(pad(bounds, padding), srid))
+# rectangle clipping, ST_Intersection is the slower fallback before PostGIS 2.2
+clip_function = 'ST_ClipByBox2D'
+
+def st_clip(geom, bounds, srid=3857):
+    return '%s(%s, %s)' % (clip_function, geom, st_bbox(bounds, srid))
+
+def st_geometry(geom, bounds, srid=3857, tolerance=0, is_clipped=True, buffer=0, validate=False):
+    """ Clip a geometry with rectangle clipping and simplify it.
+
+        Geometries are clipped to the bounds padded by buffer and by the
+        tolerance, so that vertices removed by simplification along the clip
+        edges never show inside the buffered tile. Simplified edges can then
+        stick out by up to the tolerance, and are trimmed to the buffered
+        tile by a second rectangle clip, which costs far less than the full
+        ST_Intersection it replaces.
+
+        Rectangle clipping and simplification can both leave polygons
+        invalid, and the geometry operations downstream fail on those, so
+        layers which may hold polygons are validated, see Layer.validate.
+
+        >>> st_geometry('g', (0, 0, 10, 10), tolerance=1, buffer=1, validate=True)
+        'ST_MakeValid(ST_ClipByBox2D(ST_SimplifyPreserveTopology(ST_ClipByBox2D(g, ST_MakeEnvelope(-2, -2, 12, 12, 3857)), 1.000000000000), ST_MakeEnvelope(-1, -1, 11, 11, 3857)))'
+        >>> st_geometry('g', (0, 0, 10, 10))
+        'ST_ClipByBox2D(g, ST_MakeEnvelope(0, 0, 10, 10, 3857))'
+        >>> st_geometry('g', (0, 0, 10, 10), is_clipped=False, tolerance=1)
+        'ST_SimplifyPreserveTopology(g, 1.000000000000)'
+    """
+    if is_clipped:
+        geom = st_clip(geom, pad(bounds, buffer + tolerance), srid)
+
+    if tolerance > 0:
+        geom = 'ST_SimplifyPreserveTopology(%s, %.12f)' % (geom, tolerance)
+
+        if is_clipped:
+            geom = st_clip(geom, pad(bounds, buffer), srid)
 
-    return 'ST_MakeValid(ST_SimplifyPreserveTopology(%s, %.12f))' % (geom, tolerance)
+    if validate:
+        geom = 'ST_MakeValid(%s)' % geom
+
+    return geom
 
 def st_scale(geom, bounds, scale):
     xmax = scale / (bounds[2] - bounds[0])
@@ -54,32 +95,59 @@ def build_bbox_query(subquery, bounds, geom='q.__geometry__', srid=3857):
             if bbox_token in query
             else query + default_bbox_filter % {'bbox': bbox})
 
-def build_query(query, bounds, srid=3857, tolerance=0, is_geo=False, is_clipped=True, scale=4096):
-    bbox = st_bbox(bounds, srid)
-    geom = 'q.__geometry__'
+def build_query(query, bounds, srid=3857, tolerance=0, is_geo=False, is_clipped=True, scale=4096, limit=None,
+                buffer=0, validate=False):
+    geom = st_geometry('q.__geometry__', bounds, srid, tolerance, is_clipped, buffer, validate)
 
-    if tolerance > 0: geom = st_simplify(geom, tolerance, bounds, srid)
-    if is_clipped: geom = 'ST_Intersection(%s, %s)' % (geom, bbox)
     if is_geo: geom = 'ST_Transform(%s, 4326)' % geom
     if scale: geom = st_scale(geom, bounds, scale)
 
-    return build_bbox_query(query, bounds, geom, srid)
+    query = build_bbox_query(query, bounds, geom, srid)
+    return query + ' LIMIT %d' % limit if limit else query
+
+# number of ancestor feature lists kept in memory for overzoomed tiles
+overzoom_cache_size = 64
+
+# size of the chunks yielded by Provider.stream()
+stream_chunk_size = 65536
 
 def get_query(layer, coord, bounds, format):
-    query = (layer.query_fn(coord.zoom)
-             if layer.query_fn
-             else u.xs_get(layer.queries, coord.zoom, layer.queries[-1]))
+    query = layer.query(coord.zoom)
 
     if not query: return None
     else:
         srid = layer.srid
-        tolerance = get_tolerance(layer.simplify, coord.zoom)
+        tolerance = layer.tolerance(coord.zoom)
         clip = layer.clip
 
-        geo_query = build_query(query, bounds, srid, tolerance, True, clip)
-        mvt_query = build_query(query, bounds, srid, tolerance, False, clip)
+        buffer = layer.buffer * (bounds[2] - bounds[0]) / layer.dim
+        validate = layer.is_validated(coord.zoom)
+
+        # without a sort function, the database order decides what is kept,
+        # unless rows of other geometry types are dropped after the query
+        limit = layer.max_features if layer.sort_fn is None and layer.geometry_types is None else None
+
+        # raw geometries, clipped and scaled by get_clip_fn() in the render process
+        if layer.client_clip and format == 'MVT':
+            return build_query(query, bounds, srid, is_clipped=False, scale=None, limit=limit, validate=layer.validate)
+
+        geo_query = build_query(query, bounds, srid, tolerance, True, clip, limit=limit, buffer=buffer, validate=validate)
+        mvt_query = build_query(query, bounds, srid, tolerance, False, clip, limit=limit, buffer=buffer, validate=validate)
         return {'JSON': geo_query, 'MVT': mvt_query}[format]
 
+def get_clip_fn(layer, coord, bounds, format, quantize=True):
+    """ Return the function clipping and scaling the raw geometries of a
+        client_clip layer, or None when PostGIS does it.
+
+        quantize: false for ancestors of overzoomed tiles, which are encoded
+        only once cut and magnified.
+    """
+    if not (layer.client_clip and format == 'MVT'):
+        return None
+
+    buffer = layer.buffer * (bounds[2] - bounds[0]) / layer.dim
+    return clip.clipper(bounds, mvt.extents, layer.clip, buffer, layer.tolerance(coord.zoom), quantize)
+
 def encode(out, name, features, coord, bounds, format):
     if format == 'MVT':
         mvt.encode(out, name, features)
@@ -96,11 +164,57 @@ def merge(out, feature_layers, coord, format):
     else:
         raise ValueError(format + ' is not supported')
 
+def chunked(strings, size):
+    ''' Join a stream of strings into chunks of at least size bytes, and a last smaller one.
+    '''
+    chunk, length = [], 0
+
+    for string in strings:
+        chunk.append(string)
+        length += len(string)
+
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+
+    if chunk:
+        yield ''.join(chunk)
+
 class Provider:
-    def __init__(self, dbinfo):
-        conn = connect(**dbinfo)
+    def __init__(self, dbinfo, metrics=metrics.Metrics(), slowlog=None):
+        self.dbinfo = dbinfo
+        self.metrics = metrics
+        self.slowlog = slowlog
+        self.inherited = []
+
+        # a list collecting the SQL of each query, set on views made by recording()
+        self.trace = None
+        self.connect()
+        self.ancestors = u.LRU(overzoom_cache_size)
+
+    def connect(self):
+        conn = connect(**self.dbinfo)
         conn.set_session(readonly=True, autocommit=True)
+        self.conn = conn
         self.db = conn.cursor(cursor_factory=RealDictCursor)
+        self.cursor = conn.cursor()
+
+    def recording(self, metrics, trace):
+        """ Return a view of the provider sharing its connection and caches,
+            which reports to its own metrics and appends the SQL of each query
+            to trace, ex: for one profiled render.
+        """
+        view = copy.copy(self)
+        view.metrics, view.trace = metrics, trace
+        return view
+
+    def reconnect(self):
+        """ Open a fresh connection in a forked process. The inherited one is
+            kept referenced rather than closed, because closing it would also
+            terminate the parent's session on the shared socket.
+        """
+        self.inherited.append(self.conn)
+        self.connect()
 
     def query_bounds(self, query, bounds, srid=3857):
         query = build_bbox_query(query, bounds, 'q.__geometry__', srid)
@@ -116,64 +230,271 @@ class Provider:
 
     def explain_analyze_query(self, query, z, x, y, srid=3857):
         query = build_bbox_query(query, u.bounds(z, x, y, srid), 'q.__geometry__', srid)
-        query = 'EXPLAIN ANALYZE ' + query
-        self.db.execute(query)
+        return self.explain_analyze(query)
+
+    def explain(self, query, analyze=False):
+        """ Return the top of a JSON query plan, optionally executing the query.
+        """
+        options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+        self.db.execute('EXPLAIN (%s) %s' % (options, query))
+
+        return self.db.fetchone()['QUERY PLAN'][0]
+
+    def explain_analyze(self, query):
+        self.db.execute('EXPLAIN ANALYZE ' + query)
 
         return self.db.fetchall()
 
-    def query(self, query, geometry_types, transform_fn, sort_fn):
-        features = []
+    def query(self, query, geometry_types, transform_fn, sort_fn, layer=None, zoom=None, bounds=None, clip_fn=None):
+        m = self.metrics
+        slowlog = self.slowlog
+        timed = m.enabled
+        clocked = timed or slowlog is not None
+        features = batch.FeatureBatch()
+        dropped = wkb_bytes = 0
+        decode_time = clip_time = transform_time = 0.0
+
+        # rows are plain tuples, looked up through a column map built once per query
+        if clocked: start = time.time()
+        self.cursor.execute(query)
+        if clocked: executed = time.time()
+        rows = self.cursor.fetchall()
+        if clocked: fetched = time.time()
+
+        if self.trace is not None:
+            self.trace.append({'layer': layer, 'zoom': zoom, 'sql': query})
+
+        if slowlog is not None and slowlog.is_slow(fetched - start):
+            slowlog.report(query, layer, zoom, bounds, fetched - start)
+
+        columns = dict((d[0], i) for (i, d) in enumerate(self.cursor.description or ()))
+        if rows:
+            assert '__geometry__' in columns, 'Missing __geometry__ in feature result'
+            assert '__id__' in columns, 'Missing __id__ in feature result'
+
+        geometry, fid = columns.get('__geometry__'), columns.get('__id__')
+        properties = [(k, i) for (k, i) in columns.items() if k not in ('__geometry__', '__id__')]
+
+        for row in rows:
+            # the geometry stays the cursor's buffer, read in place by the type
+            # filter and copied straight into the batch, unless shapely parses it
+            view = row[geometry]
+            wkb_bytes += len(view)
+
+            # raw geometries may change type when clipped, so they're filtered after it
+            if geometry_types is not None and not clip_fn:
+                if wkbs.geometry_type(view) not in geometry_types:
+                    dropped += 1
+                    continue
 
-        self.db.execute(query)
-        for row in self.db.fetchall():
-            assert '__geometry__' in row, 'Missing __geometry__ in feature result'
-            assert '__id__' in row, 'Missing __id__ in feature result'
+            if timed: decoding = time.time()
+            wkb = view
+            shape = shapely.wkb.loads(str(view)) if transform_fn or clip_fn else None
+            if timed: decoded = time.time(); decode_time += decoded - decoding
 
-            wkb = bytes(row.pop('__geometry__'))
-            id = row.pop('__id__')
-            shape = shapely.wkb.loads(wkb)
+            if clip_fn:
+                shape = clip_fn(shape)
+                if timed: clipped = time.time(); clip_time += clipped - decoded; decoded = clipped
 
-            if geometry_types is not None:
-                if shape.type not in geometry_types:
+                if shape is None or (geometry_types is not None and shape.geom_type not in geometry_types):
+                    dropped += 1
                     continue
 
-            props = dict((k, v) for k, v in row.items() if v is not None)
+            id = row[fid]
+            props = dict((k, row[i]) for (k, i) in properties if row[i] is not None)
 
             if transform_fn:
                 shape, props, id = transform_fn(shape, props, id)
+
+            if shape is not None:
                 wkb = shapely.wkb.dumps(shape)
 
-            features.append((wkb, props, id))
+            if timed: transform_time += time.time() - decoded
+            features.append(wkb, props, id)
 
+        if timed: sorting = time.time()
         if sort_fn:
-            features = sort_fn(features)
+            features = features.sorted(sort_fn)
+
+        if timed:
+            m.timing('sql', layer, zoom, executed - start)
+            m.timing('fetch', layer, zoom, fetched - executed)
+            m.timing('decode', layer, zoom, decode_time)
+            if clip_fn: m.timing('clip', layer, zoom, clip_time)
+            m.timing('transform', layer, zoom, transform_time)
+            m.timing('sort', layer, zoom, time.time() - sorting)
+            m.count('rows', layer, zoom, len(rows))
+            m.count('dropped', layer, zoom, dropped)
+            m.count('wkb_bytes', layer, zoom, wkb_bytes)
+            m.count('features', layer, zoom, len(features))
 
         return features
 
-    def get_features(self, layer, coord, bounds, format):
+    def get_ancestor_features(self, layer, coord, format):
+        """ Return the features of an ancestor tile and their spatial index,
+            cached for its other descendants.
+        """
+        key = (layer.name, coord.zoom, coord.column, coord.row, format)
+        cached = self.ancestors.get(key)
+
+        if cached is None:
+            bounds = u._bounds(coord, layer.srid)
+            features = self.get_features(layer, coord, bounds, format, quantize=False)
+            cached = features, spatial.GridIndex(features)
+            self.ancestors.put(key, cached)
+
+        return cached
+
+    def get_overzoomed_features(self, layer, coord, format):
+        parent = overzoom.ancestor(coord, layer.max_zoom)
+        features, index = self.get_ancestor_features(layer, parent, format)
+
+        buffer = layer.buffer * mvt.extents / float(layer.dim)
+
+        return overzoom.cut(features, parent, coord, layer.clip, layer.geometry_types, index=index, buffer=buffer)
+
+    def get_features(self, layer, coord, bounds, format, quantize=True):
+        if layer.is_overzoomed(coord.zoom):
+            return self.get_overzoomed_features(layer, coord, format)
+
         query = get_query(layer, coord, bounds, format)
         geometry_types = layer.geometry_types
         transform_fn = layer.transform_fn
         sort_fn = layer.sort_fn
 
-        return ([] if not query
-                else self.query(query, geometry_types, transform_fn, sort_fn))
+        if not query: return []
+
+        clip_fn = get_clip_fn(layer, coord, bounds, format, quantize)
+        features = self.query(query, geometry_types, transform_fn, sort_fn, layer.name, coord.zoom, bounds, clip_fn)
+        return self.fit_budget(layer, coord, bounds, format, features)
+
+    def fit_budget(self, layer, coord, bounds, format, features):
+        m = self.metrics
+
+        if layer.max_features is not None and len(features) > layer.max_features:
+            m.count('thinned_features', layer.name, coord.zoom, len(features) - layer.max_features)
+            m.count('thinned_tiles', layer.name, coord.zoom)
+            features = budget.thin(features, layer.max_features)
+
+        if layer.max_bytes is not None:
+            def measure(features):
+                buff = StringIO()
+                encode(buff, layer.name, features, coord, bounds, format)
+                return buff.tell()
+
+            count = len(features)
+            features, reduced = budget.fit(features, layer.max_bytes, measure)
+
+            if reduced:
+                m.count('%s_tiles' % reduced, layer.name, coord.zoom)
+            if count > len(features):
+                m.count('thinned_features', layer.name, coord.zoom, count - len(features))
+
+        return features
 
     def get_feature_layer(self, layer, coord, format):
         bounds = u._bounds(coord, layer.srid)
         features = self.get_features(layer, coord, bounds, format)
         return {'name': layer.name, 'features': features}
 
-    def render_tile(self, lols, coord, format):
+    def get_pyramid_features(self, layer, coord, format, children):
+        """ Build a layer's features from the (dx, dy, features) of its four child tiles.
+
+            A layer without a query at the tile's zoom has no features there,
+            like when it's rendered from the database.
+        """
+        if not layer.query(coord.zoom):
+            return []
+
+        bounds = u._bounds(coord, layer.srid)
+        tolerance = layer.simplify_pixels * mvt.extents / layer.dim
+        features = pyramid.merge(children, tolerance, layer.geometry_types)
+
+        if layer.sort_fn:
+            features = layer.sort_fn(features)
+
+        return self.fit_budget(layer, coord, bounds, format, features)
+
+    def render_feature_layers(self, feature_layers, coord, format, key=None):
+        """ Encode a tile from its feature layers.
+
+            key: the layer key labeling the tile's metrics, ex: "all" from
+            Config.resolve_layers(). Defaults to the comma-joined layer names.
+        """
+        buff = StringIO()
+        name = key or ','.join(l['name'] for l in feature_layers)
+
+        if self.metrics.enabled: start = time.time()
+        merge(buff, feature_layers, coord, format)
+        body = buff.getvalue()
+
+        if self.metrics.enabled:
+            self.metrics.timing('encode', name, coord.zoom, time.time() - start)
+            self.metrics.count('tile_bytes', name, coord.zoom, len(body))
+
+        return body
+
+    def render(self, lols, coord, format, key=None):
         buff = StringIO()
 
         if type(lols) is list:
             get_feature_layer = lambda l : self.get_feature_layer(l, coord, format)
             feature_layers = map(get_feature_layer, lols)
-            merge(buff, feature_layers, coord, format)
+            return self.render_feature_layers(feature_layers, coord, format, key), feature_layers
         else:
+            name = key or lols.name
             bounds = u._bounds(coord, lols.srid)
             features = self.get_features(lols, coord, bounds, format)
+            feature_layers = [{'name': lols.name, 'features': features}]
+            if self.metrics.enabled: start = time.time()
             encode(buff, lols.name, features, coord, bounds, format)
 
-        return buff.getvalue()
+        body = buff.getvalue()
+
+        if self.metrics.enabled:
+            self.metrics.timing('encode', name, coord.zoom, time.time() - start)
+            self.metrics.count('tile_bytes', name, coord.zoom, len(body))
+
+        return body, feature_layers
+
+    def render_tile(self, lols, coord, format, key=None):
+        return self.render(lols, coord, format, key)[0]
+
+    def stream(self, lols, coord, format, feature_layers=None, key=None):
+        """ Render a tile like render() with a list of layers, yielding chunks
+            of the body as each layer is queried and encoded.
+
+            feature_layers: optional list, or a tileindex.Classifier, which
+            gets each layer's {'name', 'features'} appended as it's rendered.
+            key: the layer key labeling the tile's metrics, see render_feature_layers().
+        """
+        layers = lols if type(lols) is list else [lols]
+        by_name = dict((l.name, l) for l in layers)
+        name = key or ','.join(l.name for l in layers)
+        size = 0
+
+        def get_features(l):
+            bounds = u._bounds(coord, l.srid)
+            features = self.get_features(l, coord, bounds, format)
+            if feature_layers is not None:
+                feature_layers.append({'name': l.name, 'features': features})
+            return features
+
+        if format == 'MVT':
+            # a tile's layers are a repeated field, so encoded layers concatenate into a tile
+            strings = (mvt.encode_layers([mvt.get_feature_layer(l.name, get_features(l))])
+                       for l in layers)
+        elif format == 'JSON':
+            strings = geojson.iter_merge([l.name for l in layers], lambda n: get_features(by_name[n]), coord.zoom)
+        else:
+            raise ValueError(format + ' is not supported')
+
+        for chunk in chunked(strings, stream_chunk_size):
+            size += len(chunk)
+            yield chunk
+
+        self.metrics.count('tile_bytes', name, coord.zoom, size)
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
@@ -0,0 +1,78 @@
+''' Tile pyramids: build a parent tile from the features of its four
+children instead of querying the database at the parent's zoom level.
+
+Children are given as (dx, dy, features), where dx and dy are the column
+and row offsets of the child within its parent, 0 or 1. Their features are
+scaled into the parent's tile space, pieces of the same feature cut by the
+children's edges are merged back together by feature id, with line pieces
+joined end to end, and the result is simplified for the parent's resolution.
+
+>>> from shapely.geometry import box
+>>> children = [(0, 0, [(box(2048, 0, 4096, 4096).wkb, {'id': 7}, None)]),
+...             (1, 0, [(box(0, 0, 2048, 4096).wkb, {'id': 7}, None)])]
+>>> [(loads(wkb).bounds, props) for (wkb, props, fid) in merge(children)]
+[((1024.0, 2048.0, 3072.0, 4096.0), {'id': 7})]
+>>> from shapely.geometry import LineString
+>>> children = [(0, 0, [(LineString([(0, 2048), (4096, 2048)]).wkb, {}, 3)]),
+...             (1, 0, [(LineString([(0, 2048), (4096, 2048)]).wkb, {}, 3)])]
+>>> [loads(wkb).wkt for (wkb, props, fid) in merge(children)]
+['LINESTRING (0 3072, 2048 3072, 4096 3072)']
+'''
+
+from collections import OrderedDict
+from shapely.wkb import loads, dumps
+from shapely.ops import unary_union, linemerge
+from shapely.affinity import affine_transform
+import tile_gen.vectiles.mvt as mvt
+
+def feature_key(props, fid):
+    ''' Identify a feature by its id, or the id property left by add_id_to_properties.
+    '''
+    return fid if fid is not None else props.get('id')
+
+def merge(children, tolerance=0, geometry_types=None, extent=mvt.extents):
+    ''' Merge the (wkb, props, fid) features of child tiles into their parent.
+    '''
+    merged = OrderedDict()
+    half = extent / 2.0
+
+    for dx, dy, features in children:
+        # rows flip into tile space like in overzoom.window()
+        matrix = [0.5, 0, 0, 0.5, dx * half, (1 - dy) * half]
+
+        for wkb, props, fid in features:
+            shape = affine_transform(loads(wkb), matrix)
+            key = feature_key(props, fid)
+
+            if key is None:
+                merged[object()] = [shape], props, fid
+            elif key in merged:
+                merged[key][0].append(shape)
+            else:
+                merged[key] = [shape], props, fid
+
+    features = []
+
+    for shapes, props, fid in merged.values():
+        shape = unary_union(shapes) if len(shapes) > 1 else shapes[0]
+
+        # the union leaves lines split where the children's edges cut them
+        if shape.type == 'MultiLineString':
+            shape = linemerge(shape)
+
+        if tolerance > 0 and shape.type not in ('Point', 'MultiPoint'):
+            shape = shape.simplify(tolerance, preserve_topology=True)
+
+        if shape.is_empty:
+            continue
+
+        if geometry_types is not None and shape.type not in geometry_types:
+            continue
+
+        features.append((dumps(shape), props, fid))
+
+    return features
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
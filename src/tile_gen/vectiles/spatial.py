@@ -0,0 +1,82 @@
+''' In-memory spatial index for the features of one tile, used when a single
+query result feeds several output tiles, e.g. overzoomed descendants cut
+from a cached ancestor.
+
+Features are bucketed by the cells of a regular grid over the tile space
+that their bounding boxes overlap. A query looks at the buckets of the
+cells it overlaps, then checks the bounding boxes of those features only.
+Positions come back in feature order, so sort orders are kept.
+
+>>> from shapely.geometry import Point, LineString
+>>> features = [(Point(100, 100).wkb, {}, 1),
+...             (LineString([(0, 0), (4096, 4096)]).wkb, {}, 2),
+...             (Point(3000, 500).wkb, {}, 3)]
+>>> index = GridIndex(features)
+>>> index.query((0, 0, 1024, 1024))
+[0, 1]
+>>> index.query_many([(2048, 0, 4096, 2048), (0, 2048, 1024, 4096)])
+[[1, 2], [1]]
+
+Only bounding boxes are compared, so the line is a candidate for any part
+of the tile; callers test the shapes themselves.
+'''
+
+from shapely.wkb import loads
+from tile_gen.vectiles.batch import FeatureBatch
+import tile_gen.vectiles.mvt as mvt
+
+class GridIndex(object):
+    ''' Grid bucket index over the bounding boxes of (wkb, props, fid) features.
+
+        features: a list of features or a FeatureBatch, in tile space.
+        extent: size of the tile space covered by the grid; features beyond
+        it, e.g. in a buffer, fall in the outermost cells.
+        cells: number of grid cells along each side.
+    '''
+    def __init__(self, features, extent=mvt.extents, cells=16):
+        self.cells = cells
+        self.size = float(extent) / cells
+        self.bounds = []
+        self.buckets = {}
+
+        if isinstance(features, FeatureBatch):
+            wkbs = (features.wkb(i) for i in features.indices())
+        else:
+            wkbs = (wkb for (wkb, props, fid) in features)
+
+        for n, wkb in enumerate(wkbs):
+            bounds = loads(wkb).bounds
+            self.bounds.append(bounds or None)
+
+            # empty geometries have no bounds, and are never found
+            if not bounds: continue
+
+            for cell in self.cells_of(bounds):
+                self.buckets.setdefault(cell, []).append(n)
+
+    def cells_of(self, (xmin, ymin, xmax, ymax)):
+        clamp = lambda n: min(max(int(n // self.size), 0), self.cells - 1)
+        return [(x, y) for x in range(clamp(xmin), clamp(xmax) + 1)
+                       for y in range(clamp(ymin), clamp(ymax) + 1)]
+
+    def query(self, bbox):
+        ''' Return the positions of features whose bounding boxes intersect (xmin, ymin, xmax, ymax).
+        '''
+        xmin, ymin, xmax, ymax = bbox
+        candidates = set()
+
+        for cell in self.cells_of(bbox):
+            candidates.update(self.buckets.get(cell, ()))
+
+        return sorted(n for n in candidates
+                      if self.bounds[n][0] <= xmax and self.bounds[n][2] >= xmin
+                      and self.bounds[n][1] <= ymax and self.bounds[n][3] >= ymin)
+
+    def query_many(self, bboxes):
+        ''' Return the positions of features intersecting each of several bounding boxes.
+        '''
+        return [self.query(bbox) for bbox in bboxes]
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()
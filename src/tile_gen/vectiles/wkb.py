@@ -35,6 +35,10 @@ wkbGeometryCollection = 7
 
 wkbMultis = wkbMultiPoint, wkbMultiLineString, wkbMultiPolygon, wkbGeometryCollection
 
+wkbTypeNames = {wkbPoint: 'Point', wkbLineString: 'LineString', wkbPolygon: 'Polygon',
+                wkbMultiPoint: 'MultiPoint', wkbMultiLineString: 'MultiLineString',
+                wkbMultiPolygon: 'MultiPolygon', wkbGeometryCollection: 'GeometryCollection'}
+
 def copy_byte(src, dest):
     ''' Copy an unsigned byte between files, and return it.
     '''
@@ -144,6 +148,19 @@ def approximate_wkb(wkb_in):
     
     return wkb_out
 
+def geometry_type(wkb):
+    ''' Return the Shapely type name of a WKB or EWKB geometry, reading only its header.
+
+        >>> geometry_type('\\x01\\x02\\x00\\x00\\x00')
+        'LineString'
+        >>> geometry_type('\\x00\\x20\\x00\\x00\\x06')
+        'MultiPolygon'
+    '''
+    (type, ) = unpack('<I' if wkb[0] == '\x01' else '>I', wkb[1:5])
+
+    # drop EWKB flags, then ISO Z/M/ZM offsets
+    return wkbTypeNames[(type & 0xffff) % 1000]
+
 if __name__ == '__main__':
 
     from random import random
@@ -0,0 +1,178 @@
+"""
+Render tiles in a pool of worker processes which share one parsed config.
+
+The pool is forked from a process that already ran core.init_env(), so each
+worker inherits the loaded layers, compiled queries and cache instead of
+importing and parsing them again. Only the database connection is made anew
+in every worker, since psycopg2 connections can't be shared across a fork.
+
+Workers write rendered tiles straight to the cache, and only send the body
+back through the pool's pipe when the caller asked for it. Empty and solid
+tiles are classified in the worker but recorded by the parent, which owns the
+tile index, so they're never written to the cache.
+
+Example:
+
+    core.init_env(config_d)
+    pool = workers.WorkerPool(core.env, processes=8)
+    try:
+        pool.render_tiles(('all', z, x, y, 'mvt') for (z, x, y) in tiles)
+        mimetype, body = pool.get_tile('water', 10, 163, 395, 'mvt')
+    finally:
+        pool.close()
+
+Per-process state such as Prometheus counters lives in each worker, prefer
+the StatsD metrics backend when rendering through a pool.
+
+Pools with different configs render with their own:
+
+>>> from tempfile import mkdtemp
+>>> from tile_gen.caches import Disk
+>>> class Provider:
+...     def __init__(self, body): self.body = body
+...     def reconnect(self): pass
+...     def render(self, layers, coord, format, key=None): return self.body, []
+>>> class Env:
+...     index = None
+...     def __init__(self, body): self.provider, self.cache = Provider(body), Disk(mkdtemp())
+...     def resolve_layers(self, layer): return layer, []
+>>> a, b = WorkerPool(Env('a'), 2), WorkerPool(Env('b'), 2)
+>>> a.get_tile('water', 1, 0, 0, 'mvt')[1], b.get_tile('water', 1, 0, 0, 'mvt')[1]
+('a', 'b')
+>>> a.render_tiles([('water', 1, 1, 0, 'mvt')]), a.env.cache.read('water', Coordinate(0, 1, 1), 'MVT')
+(1, 'a')
+>>> a.close(); b.close()
+"""
+
+from ModestMaps.Core import Coordinate
+from multiprocessing import Pool
+import tile_gen.util as u
+import tile_gen.tileindex as ti
+
+# The Config of the pool a worker process belongs to, set in the worker only.
+_env = None
+
+def _init_worker(env):
+    global _env
+    _env = env
+    _env.provider.reconnect()
+
+def _render(job):
+    """ Render one tile in a worker, and return what the parent needs to finish it.
+
+        Returns (job, kind, body), where kind is ti.EMPTY or ti.SOLID when the
+        parent should index the tile, and body is None when it wasn't asked
+        for. Returns None for a cached tile whose body wasn't asked for.
+    """
+    key, z, x, y, ext, ignore_cached, want_body = job
+
+    layers   = _env.resolve_layers(key)[1]
+    cache    = _env.cache
+    coord    = Coordinate(y, x, z)
+    format   = u.get_type_by_ext(ext)[1]
+
+    # workers lock tiles like core.get_tile(), which may run alongside them
+    if cache:
+        cache.lock(key, coord, format)
+    try:
+        if cache and not ignore_cached:
+            body = cache.read(key, coord, format)
+            if body is not None: return (job, None, body) if want_body else None
+
+        body, feature_layers = _env.provider.render(layers, coord, format, key)
+        kind = ti.classify(layers, feature_layers, format) if _env.index else None
+
+        if kind is None:
+            if cache: cache.save(body, key, coord, format)
+            if not want_body: body = None
+    finally:
+        if cache:
+            cache.unlock(key, coord, format)
+
+    return job, kind, body
+
+class WorkerPool:
+    """ A pool of forked render workers.
+
+        env: the Config to render with, ex: core.env.
+        processes: number of worker processes, defaults to cpu count.
+        chunksize: number of tiles handed to a worker at once by render_tiles().
+    """
+    def __init__(self, env, processes=None, chunksize=16):
+        self.env = env
+        self.chunksize = chunksize
+
+        # forked workers inherit env, pools with different configs don't share it
+        self.pool = Pool(processes, initializer=_init_worker, initargs=(env, ))
+
+    def _finish(self, result):
+        job, kind, body = result
+        key, z, x, y, ext = job[:5]
+
+        if self.env.index:
+            coord = Coordinate(y, x, z)
+            format = u.get_type_by_ext(ext)[1]
+
+            if kind is not None:
+                self.env.index.record(key, self.env.resolve_layers(key)[1], coord, format, body, kind)
+            else:
+                self.env.index.forget(key, coord, format)
+
+        return body
+
+    def get_tile(self, layer, z, x, y, ext, ignore_cached=False):
+        """ Like core.get_tile(), but render in a worker process.
+
+            Cache and index hits are answered by the calling process.
+        """
+        key = self.env.resolve_layers(layer)[0]
+        mimetype, format = u.get_type_by_ext(ext)
+        coord = Coordinate(y, x, z)
+
+        if not ignore_cached:
+            if self.env.index:
+                body = self.env.index.lookup(key, coord, format)
+                if body is not None: return mimetype, body
+
+            if self.env.cache:
+                body = self.env.cache.read(key, coord, format)
+                if body is not None: return mimetype, body
+
+        job = (key, z, x, y, ext, True, True)
+        return mimetype, self._finish(self.pool.apply(_render, (job,)))
+
+    def render_tiles(self, tiles, ignore_cached=False):
+        """ Render (layer, z, x, y, ext) tuples into the cache, and return how many were rendered.
+
+            Tiles already in the cache or index are skipped, unless ignore_cached.
+        """
+        index = self.env.index
+        jobs = []
+
+        for layer, z, x, y, ext in tiles:
+            key = self.env.resolve_layers(layer)[0]
+
+            if index and not ignore_cached:
+                format = u.get_type_by_ext(ext)[1]
+                if index.lookup(key, Coordinate(y, x, z), format) is not None: continue
+
+            # the body is only needed back when the tile index will take it
+            jobs.append((key, z, x, y, ext, ignore_cached, False))
+
+        rendered = 0
+        for result in self.pool.imap_unordered(_render, jobs, self.chunksize):
+            if result is None: continue
+            self._finish(result)
+            rendered += 1
+
+        if index and index.path: index.save()
+
+        return rendered
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+if __name__ == '__main__':
+    from doctest import testmod
+    testmod()